@@ -1,7 +1,18 @@
 import json
+import os
 
 
 def pprint(data):
     
     return json.dumps(data, indent=4)
-    
+
+
+def env_int(name, default=None):
+    '''
+    Reads an integer from env var 'name', falling back to 'default' when it is
+    unset or empty.
+    '''
+
+    value = os.environ.get(name)
+
+    return int(value) if value else default
@@ -0,0 +1,212 @@
+import os
+import errno
+import fcntl
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from tesk_core.Util import env_int
+from tesk_core.fastcopy import copy_data
+
+MB = 1024 * 1024
+
+_cache_lock = threading.Lock()
+_cache = None
+
+
+def input_cache():
+    '''
+    The node-local input cache mounted at FILER_CACHE_DIR, or None if the
+    taskmaster did not mount one (see Filer.add_cache_mount).
+    '''
+
+    global _cache
+    root = os.environ.get('FILER_CACHE_DIR')
+    if root is None:
+        return None
+    with _cache_lock:
+        if _cache is None or _cache.root != root:
+            _cache = InputCache(root, env_int('FILER_CACHE_MAX_MB', 100 * 1024) * MB)
+        return _cache
+
+
+def cache_key(url, validator):
+    return hashlib.sha256('{}\0{}'.format(url, validator).encode('utf-8')).hexdigest()
+
+
+def clone_file(source, destination):
+    '''
+    Makes 'destination' a copy of 'source': a hard link if FILER_CACHE_HARDLINK
+    is set (only safe when executors never modify their inputs in place), an
+    in-kernel copy otherwise (see fastcopy.copy_data).
+    '''
+
+    if env_int('FILER_CACHE_HARDLINK', 0):
+        try:
+            os.link(source, destination)
+            return
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        copy_data(src, dst)
+
+
+class InputCache:
+    '''
+    Input files shared by the tasks of a node (or of every node, on a
+    ReadWriteMany volume), stored under a hash of their URL and of a
+    validator (ETag, Last-Modified, version, ...) so a changed remote file
+    is never served stale:
+
+        objects/<key>   the cached files; their mtime is their last use
+        locks/<key>     held while the file is being filled or evicted, and
+                        removed with the file
+        tmp/            files being filled
+
+    Least recently used files are evicted once a fill may have pushed the
+    cache over 'max_size' bytes.
+    '''
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        # Bytes in the cache as of the last scan plus what this filer added
+        # since; None until the first fill scans the cache
+        self.used = None
+        self.used_lock = threading.Lock()
+        for subdir in ('objects', 'locks', 'tmp'):
+            os.makedirs(os.path.join(root, subdir), exist_ok=True)
+
+    def object_path(self, key):
+        return os.path.join(self.root, 'objects', key)
+
+    def lock_path(self, key):
+        return os.path.join(self.root, 'locks', key)
+
+    @contextmanager
+    def locked(self, key, blocking=True):
+        '''
+        Holds the lock of 'key' across processes and pods. Yields False if not
+        'blocking' and another filer holds it.
+
+        Lock files are removed by their holder (see remove_lock), so a lock
+        taken on a file no longer at its path is let go and taken again.
+        '''
+        while True:
+            with open(self.lock_path(key), 'a') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                except BlockingIOError:
+                    yield False
+                    return
+                try:
+                    current = os.stat(self.lock_path(key)).st_ino == os.fstat(lock.fileno()).st_ino
+                except FileNotFoundError:
+                    current = False
+                if not current:
+                    continue
+                try:
+                    yield True
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+                return
+
+    def remove_lock(self, key):
+        '''
+        Removes the lock file of 'key'. Only call this holding the lock.
+        '''
+        try:
+            os.remove(self.lock_path(key))
+        except FileNotFoundError:
+            pass
+
+    def fetch(self, transfer):
+        '''
+        Downloads the file of 'transfer' through the cache: on a hit it is
+        copied out of the cache, on a miss it is downloaded into the cache
+        first. Only one filer downloads a given file; others wait for it.
+        Files without a validator bypass the cache.
+        '''
+        validator = transfer.cache_validator()
+        if validator is None:
+            logging.debug('Not caching %s, it has no validator', transfer.url)
+            return transfer.download_file()
+
+        key = cache_key(transfer.url, validator)
+        cached = self.object_path(key)
+        filled = None
+        with self.locked(key):
+            if os.path.exists(cached):
+                logging.info('Cache hit for %s', transfer.url)
+                os.utime(cached)
+            else:
+                result = self.fill(transfer, key)
+                if result:
+                    self.remove_lock(key)
+                    return result
+                filled = os.path.getsize(cached)
+
+            os.makedirs(os.path.dirname(transfer.path) or '.', exist_ok=True)
+            clone_file(cached, transfer.path)
+
+        if filled is not None:
+            self.account(filled)
+        return 0
+
+    def account(self, size):
+        '''
+        Adds 'size' filled bytes to the usage of the cache, evicting (and
+        scanning the cache again) only when that may exceed the budget.
+        '''
+        with self.used_lock:
+            if self.used is not None and self.used + size <= self.max_size:
+                self.used += size
+                return
+        self.evict()
+
+    def fill(self, transfer, key):
+        logging.info('Cache miss for %s', transfer.url)
+        path = transfer.path
+        transfer.path = os.path.join(self.root, 'tmp', '{}.{}'.format(key, os.getpid()))
+        try:
+            result = transfer.download_file()
+            if not result:
+                os.replace(transfer.path, self.object_path(key))
+            elif os.path.exists(transfer.path):
+                os.remove(transfer.path)
+        finally:
+            transfer.path = path
+        return result
+
+    def evict(self):
+        '''
+        Removes the least recently used files until the cache fits its size
+        budget, skipping files other filers are using.
+        '''
+        objects = []
+        for entry in os.scandir(os.path.join(self.root, 'objects')):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            objects.append((stat.st_mtime, stat.st_size, entry.name))
+
+        total = sum(size for _, size, _ in objects)
+        for _, size, key in sorted(objects):
+            if total <= self.max_size:
+                break
+            with self.locked(key, blocking=False) as acquired:
+                if not acquired:
+                    continue
+                try:
+                    os.remove(self.object_path(key))
+                except FileNotFoundError:
+                    pass
+                self.remove_lock(key)
+            logging.debug('Evicted %s from the cache', key)
+            total -= size
+
+        with self.used_lock:
+            self.used = total
@@ -0,0 +1,154 @@
+import os
+import json
+import logging
+import threading
+
+
+def resumable():
+    '''
+    Transfers are resumable when the taskmaster gave the filer a checkpoint
+    directory on the task volume (see Filer.add_checkpoint_mount).
+    '''
+
+    return os.environ.get('FILER_CHECKPOINT_DIR') is not None
+
+
+def partial_path(path):
+    '''
+    Downloads are written here and renamed to 'path' once complete, so a
+    file at 'path' is always whole.
+    '''
+
+    return path + '.part'
+
+
+def partial_offset(path):
+    '''
+    Number of bytes of 'path' already downloaded by an interrupted run: the
+    size of its partial file. Resumable partial files are therefore written
+    in order and never preallocated.
+    '''
+
+    try:
+        return os.path.getsize(partial_path(path))
+    except OSError:
+        return 0
+
+
+def validator_path(path):
+    return partial_path(path) + '.validator'
+
+
+def start_partial(path, validator):
+    '''
+    Records the 'validator' (ETag, Last-Modified, ...) of the remote version
+    a new partial file of 'path' is downloaded from, so a later run only
+    appends to it from that same version. Partial files without one are
+    never resumed.
+    '''
+
+    if validator is None:
+        _remove(validator_path(path))
+        return
+    with open(validator_path(path), 'w') as fh:
+        fh.write(validator)
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+def partial_validator(path):
+    try:
+        with open(validator_path(path)) as fh:
+            return fh.read() or None
+    except OSError:
+        return None
+
+
+def resume_offset(path, validator):
+    '''
+    The partial_offset of 'path' if its partial file was downloaded from the
+    remote version 'validator', else 0, with the partial file discarded, so
+    two versions of a file are never spliced together.
+    '''
+
+    offset = partial_offset(path)
+    if offset and (validator is None or partial_validator(path) != validator):
+        logging.info('%s changed remotely since it was partially downloaded, restarting', path)
+        discard_partial(path)
+        return 0
+    return offset
+
+
+def discard_partial(path):
+    _remove(partial_path(path))
+    _remove(validator_path(path))
+
+
+def finish_partial(path):
+    os.replace(partial_path(path), path)
+    _remove(validator_path(path))
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class Manifest:
+    '''
+    The entries of a filer run that were transferred completely, kept as
+    JSON lines in 'path' on the task volume. A filer pod restarted by the
+    job's backoffLimit skips them instead of transferring everything again.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.completed = set()
+
+        if os.path.exists(path):
+            with open(path) as fh:
+                for line in fh:
+                    try:
+                        self.completed.add(self.key(json.loads(line)))
+                    except ValueError:
+                        # Last line of a run killed while writing it
+                        logging.debug('Ignoring damaged manifest line: %s', line)
+            logging.info('Resuming: %d transfers already completed', len(self.completed))
+
+    @staticmethod
+    def key(filedata):
+        return filedata.get('url'), filedata['path'], filedata.get('type')
+
+    def done(self, filedata):
+        return self.key(filedata) in self.completed
+
+    def record(self, filedata):
+        line = json.dumps({'url': filedata.get('url'),
+                           'path': filedata['path'],
+                           'type': filedata.get('type')})
+        with self.lock:
+            self.completed.add(self.key(filedata))
+            with open(self.path, 'a') as fh:
+                fh.write(line + '\n')
+                fh.flush()
+                os.fsync(fh.fileno())
+
+    def wrap(self, process):
+        '''
+        Wraps 'process(ttype, filedata)' to skip completed entries and to
+        record the ones it completes.
+        '''
+
+        def process_checkpointed(ttype, filedata):
+            if self.done(filedata):
+                logging.info('Skipping %s, transferred by a previous run', filedata['path'])
+                return 0
+            result = process(ttype, filedata)
+            if not result:
+                self.record(filedata)
+            return result
+
+        return process_checkpointed
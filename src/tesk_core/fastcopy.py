@@ -0,0 +1,119 @@
+import os
+import errno
+import fcntl
+import logging
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from tesk_core.Util import env_int
+
+# Linux ioctl to share the blocks of a file on copy-on-write filesystems
+FICLONE = 0x40049409
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# Errors meaning "not supported between these files", not "copy failed"
+UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+               errno.ENOTTY, errno.EBADF, errno.EPERM)
+
+
+def copy_data(src, dst):
+    '''
+    Copies the contents of the open file 'src' into the empty open file 'dst'
+    inside the kernel: a reflink where the filesystem supports one, else
+    copy_file_range (server side on NFS 4.2 and CephFS), else sendfile, and
+    a userspace copy as the last resort. A method that stops short, as some
+    filesystems make them do, leaves the rest to the next one.
+    '''
+
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return
+    except OSError as err:
+        if err.errno not in UNSUPPORTED:
+            raise
+
+    size = os.fstat(src.fileno()).st_size
+    copied = 0
+    for syscall in (getattr(os, 'copy_file_range', None), os.sendfile):
+        if syscall is None:
+            continue
+        if syscall is os.sendfile:
+            # sendfile writes at the file position, copy_file_range does not move it
+            os.lseek(dst.fileno(), copied, os.SEEK_SET)
+        try:
+            while copied < size:
+                if syscall is os.sendfile:
+                    sent = os.sendfile(dst.fileno(), src.fileno(), copied, CHUNK_SIZE)
+                else:
+                    sent = syscall(src.fileno(), dst.fileno(), CHUNK_SIZE, copied, copied)
+                if not sent:
+                    break
+                copied += sent
+        except OSError as err:
+            if err.errno not in UNSUPPORTED:
+                raise
+        if copied >= size:
+            return
+        logging.debug('Copy stopped at byte %d of %d, falling back', copied, size)
+
+    src.seek(copied)
+    dst.seek(copied)
+    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+
+def unchanged(src, dst):
+    '''
+    Whether 'dst' has the size and modification time of 'src', i.e. is
+    taken to be a copy of it already.
+    '''
+
+    try:
+        src_stat, dst_stat = os.stat(src), os.stat(dst)
+    except OSError:
+        return False
+    return src_stat.st_size == dst_stat.st_size and \
+        int(src_stat.st_mtime) == int(dst_stat.st_mtime)
+
+
+def copy_file(src, dst):
+    '''
+    Copies the file 'src' to 'dst' (or into 'dst' if it is a directory), like
+    shutil.copy but with the data copied in the kernel and the modification
+    time kept. With FILER_COPY_SKIP_UNCHANGED set, files already at 'dst' with
+    the same size and modification time are not copied again.
+    '''
+
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if env_int('FILER_COPY_SKIP_UNCHANGED', 0) and unchanged(src, dst):
+        logging.debug('Skipping unchanged %s', dst)
+        return dst
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        copy_data(fsrc, fdst)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def copy_tree(src, dst):
+    '''
+    Copies the contents of the directory 'src' into 'dst', which is created
+    if needed and merged into if it exists. Directories are created first,
+    then the files are copied by FILER_COPY_WORKERS threads (default 4).
+    '''
+
+    files = []
+    for root, _, names in os.walk(src, followlinks=True):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        files.extend((os.path.join(root, name), os.path.join(target, name))
+                     for name in names)
+
+    logging.debug('Copying %d files from %s to %s', len(files), src, dst)
+    workers = env_int('FILER_COPY_WORKERS', 4)
+    if workers <= 1 or len(files) <= 1:
+        for source, target in files:
+            copy_file(source, target)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # list() raises the first error of any copy
+            list(executor.map(lambda pair: copy_file(*pair), files))
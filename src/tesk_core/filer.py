@@ -3,6 +3,7 @@
 from ftplib import FTP
 import ftplib
 import argparse
+import collections
 import sys
 import json
 import re
@@ -11,42 +12,317 @@ import distutils.dir_util
 import logging
 import netrc
 import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import gzip
+import base64
+import binascii
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from tesk_core.exception import UnknownProtocol, FileProtocolDisabled
-import shutil
 from glob import glob
-from tesk_core.path import containerPath, getPath, fileEnabled
+from tesk_core.path import containerPath, getPath, fileEnabled, directInput, fileVolumeMounted
 from tesk_core.transput import Type, Transput, urlparse
-from tesk_core.filer_s3 import S3Transput
+from tesk_core.filer_s3 import S3Transput, shutdown_transfer_managers, s3_etag
+from tesk_core.Util import env_int
+from tesk_core.scheduler import run_transfers
+from tesk_core.planner import plan_transfers, check_destinations
+from tesk_core.retry import retrying, TRANSIENT_HTTP_STATUS
+from tesk_core.cache import input_cache
+from tesk_core.fastcopy import copy_file, copy_tree
+from tesk_core.checkpoint import Manifest, resumable, partial_path, partial_offset, finish_partial, \
+    start_partial, partial_validator, resume_offset, discard_partial
 
 
 
 
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def http_session():
+    '''
+    Returns the requests session shared by every HTTP transfer of the filer run,
+    so connections (and TLS sessions) to a host are kept alive and reused.
+
+    FILER_HTTP_POOL_SIZE sets the number of connections kept per host and
+    FILER_HTTP_RETRIES how often connection errors and 502/503/504 responses
+    are retried, with exponential backoff.
+    '''
+
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            pool_size = env_int('FILER_HTTP_POOL_SIZE', 10)
+            retries = Retry(total=env_int('FILER_HTTP_RETRIES', 3),
+                            backoff_factor=0.5,
+                            status_forcelist=(502, 503, 504),
+                            raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=pool_size,
+                                  pool_maxsize=pool_size,
+                                  max_retries=retries)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+        return _http_session
+
+
+def http_validator(headers):
+    '''
+    The validator of the version of an object a response is about, usable in
+    If-Range: its strong ETag, or else its Last-Modified. None if it has neither.
+    '''
+
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified')
+
+
+def remote_md5(headers):
+    '''
+    The MD5 hexdigest of an object as a response gives it: its Content-MD5, or
+    else its strong ETag if that is a plain MD5 (as S3 and many servers make
+    it). None if neither gives one.
+    '''
+
+    content_md5 = headers.get('Content-MD5')
+    if content_md5:
+        try:
+            return base64.b64decode(content_md5, validate=True).hex()
+        except (binascii.Error, ValueError):
+            return None
+    etag = headers.get('ETag', '')
+    if not etag.startswith('W/') and re.fullmatch(r'"?[0-9a-fA-F]{32}"?', etag):
+        return etag.strip('"').lower()
+    return None
+
+
 class HTTPTransput(Transput):
     def __init__(self, path, url, ftype):
         Transput.__init__(self, path, url, ftype)
 
     def download_file(self):
-        req = requests.get(self.url)
+        chunk_size = env_int('FILER_HTTP_CHUNK_SIZE', 1024 * 1024)
+
+        segments = env_int('FILER_HTTP_SEGMENTS', 1)
+        if segments > 1:
+            size, validator = self.ranged_size()
+            if size is not None and \
+                    size >= env_int('FILER_HTTP_SEGMENT_MIN_SIZE', 64 * 1024 * 1024):
+                result = self.download_segmented(size, validator, segments, chunk_size)
+                if result is not None:
+                    return result
+                logging.info('Ranges of %s were not served, downloading it in one stream',
+                             self.url)
+
+        return self.download_stream(chunk_size)
+
+    def download_stream(self, chunk_size):
+        target, offset, kwargs = self.path, 0, {}
+        if resumable():
+            target = partial_path(self.path)
+            validator = partial_validator(self.path)
+            offset = partial_offset(self.path) if validator else 0
+            if offset:
+                logging.info('Resuming download of %s at byte %d', self.url, offset)
+                # If the object changed, the server sends all of the new version
+                kwargs['headers'] = {'Range': 'bytes={}-'.format(offset),
+                                     'If-Range': validator}
+
+        with http_session().get(self.url, stream=True, **kwargs) as req:
+            if req.status_code < 200 or req.status_code >= 300:
+                logging.error('Got status code: %d', req.status_code)
+                logging.error(req.text)
+                if req.status_code == 416:
+                    # The remote file shrank since the partial file was written
+                    discard_partial(self.path)
+                self.transient = req.status_code in TRANSIENT_HTTP_STATUS
+                return 1
+            logging.debug('OK, got status code: %d', req.status_code)
+            if req.status_code != 206:
+                # The server ignored the Range, or the object changed, and sent the whole file
+                offset = 0
+            if target != self.path and not offset:
+                start_partial(self.path, http_validator(req.headers))
+
+            # Content-Length is only the size on disk if the body is not encoded
+            size = None
+            if 'Content-Encoding' not in req.headers and \
+                    req.headers.get('Content-Length', '').isdigit():
+                size = int(req.headers['Content-Length'])
+
+            written = 0
+            with open(target, 'ab' if offset else 'wb') as file:
+                # The size of a partial file is its resume offset, so it is not preallocated
+                if size and target == self.path:
+                    preallocate(file, size)
+                for chunk in req.iter_content(chunk_size=chunk_size):
+                    file.write(chunk)
+                    written += len(chunk)
+
+        logging.debug('Downloaded %d bytes from %s', written, self.url)
+        if size is not None and written != size:
+            logging.error('Download of %s incomplete: got %d of %d bytes',
+                          self.url, written, size)
+            self.transient = True
+            return 1
+        if target != self.path:
+            finish_partial(self.path)
+        return 0
 
-        if req.status_code < 200 or req.status_code >= 300:
-            logging.error('Got status code: %d', req.status_code)
-            logging.error(req.text)
+    def ranged_size(self):
+        '''
+        Returns the size of the object and a validator of its version (its
+        strong ETag, or else its Last-Modified) if the server accepts byte
+        ranges for it, (None, None) otherwise.
+        '''
+        try:
+            req = http_session().head(self.url, allow_redirects=True)
+        except requests.RequestException as err:
+            logging.debug('Could not probe %s for ranges: %s', self.url, err)
+            return None, None
+        validator = http_validator(req.headers)
+        if req.status_code != 200 or \
+                req.headers.get('Accept-Ranges') != 'bytes' or \
+                'Content-Encoding' in req.headers or \
+                not req.headers.get('Content-Length', '').isdigit() or \
+                validator is None:
+            return None, None
+        return int(req.headers['Content-Length']), validator
+
+    def download_segmented(self, size, validator, segments, chunk_size):
+        '''
+        Downloads the object as 'segments' byte ranges over concurrent
+        connections, each written at its offset into the preallocated file.
+        Every range is asked for with If-Range 'validator', so a range of a
+        version other than the one sized is never written: the server sends
+        the whole object instead, and this returns None for the caller to
+        download it in one stream.
+        '''
+        segment_size = -(-size // segments)
+        ranges = [(start, min(start + segment_size, size) - 1)
+                  for start in range(0, size, segment_size)]
+        logging.debug('Downloading %s (%d bytes) in %d segments',
+                      self.url, size, len(ranges))
+
+        target = self.path
+        if resumable():
+            target = partial_path(self.path)
+            # A preallocated file has no meaningful offset to resume from
+            start_partial(self.path, None)
+        with open(target, 'wb') as file:
+            preallocate(file, size)
+            file.truncate(size)
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                results = list(executor.map(
+                    lambda r: self.download_range(file.fileno(), r[0], r[1],
+                                                  validator, chunk_size),
+                    ranges))
+
+        if None in results:
+            os.remove(target)
+            return None
+        if any(results):
             return 1
-        logging.debug('OK, got status code: %d', req.status_code)
+        if target != self.path:
+            finish_partial(self.path)
+        return 0
 
-        with open(self.path, 'wb') as file:
-            file.write(req.content)
+    def download_range(self, fd, start, end, validator, chunk_size):
+        headers = {'Range': 'bytes={}-{}'.format(start, end), 'If-Range': validator}
+        with http_session().get(self.url, headers=headers, stream=True) as req:
+            if req.status_code == 200:
+                # The range was ignored, or the object changed since it was sized
+                return None
+            if req.status_code != 206:
+                logging.error('Got status code: %d for range %d-%d of %s',
+                              req.status_code, start, end, self.url)
+                self.transient = req.status_code in TRANSIENT_HTTP_STATUS
+                return 1
+            offset = start
+            for chunk in req.iter_content(chunk_size=chunk_size):
+                os.pwrite(fd, chunk, offset)
+                offset += len(chunk)
+
+        if offset != end + 1:
+            logging.error('Download of range %d-%d of %s incomplete: got %d bytes',
+                          start, end, self.url, offset - start)
+            self.transient = True
+            return 1
         return 0
 
+    def destination_unchanged(self):
+        '''
+        The remote file is taken to be unchanged if a HEAD on it reports the
+        local size and either the MD5 of the local file (as Content-MD5 or as
+        a plain MD5 ETag) or, when the server gives neither, a Last-Modified
+        no older than the local file. The latter only holds for files this run
+        already uploaded: outputs rewritten by a rerun are newer and sent again.
+        '''
+        try:
+            req = http_session().head(self.url, allow_redirects=True)
+        except requests.RequestException:
+            return False
+        if req.status_code != 200 or \
+                req.headers.get('Content-Length') != str(os.path.getsize(self.path)):
+            return False
+        md5 = remote_md5(req.headers)
+        if md5 is not None:
+            return md5 == s3_etag(self.path)
+        if 'Last-Modified' not in req.headers:
+            return False
+        try:
+            modified = parsedate_to_datetime(req.headers['Last-Modified']).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return modified >= int(os.path.getmtime(self.path))
+
+    def output_check(self):
+        try:
+            req = http_session().options(self.url)
+        except requests.RequestException as err:
+            logging.error('Unable to reach %s: %s', self.url, err)
+            return 1
+        if req.status_code in (401, 403):
+            logging.error('Got status code: %d for %s', req.status_code, self.url)
+            return 1
+        return 0
+
+    def input_size(self):
+        if self.ftype == Type.Directory:
+            return None, None
+        req = http_session().head(self.url, allow_redirects=True)
+        if req.status_code in (404, 410):
+            raise FileNotFoundError('Got status code: {}'.format(req.status_code))
+        length = req.headers.get('Content-Length', '')
+        if req.status_code != 200 or 'Content-Encoding' in req.headers or not length.isdigit():
+            return None, None
+        return int(length), 1
+
+    def cache_validator(self):
+        try:
+            req = http_session().head(self.url, allow_redirects=True)
+        except requests.RequestException:
+            return None
+        validator = req.headers.get('ETag') or req.headers.get('Last-Modified')
+        if req.status_code != 200 or validator is None:
+            return None
+        return '{} {}'.format(validator, req.headers.get('Content-Length'))
+
     def upload_file(self):
-        with open(self.path, 'r') as file:
-            file_contents = file.read()
-        req = requests.put(self.url, data=file_contents)
+        # Passing the open file makes requests send it with its Content-Length,
+        # reading it block by block instead of loading it into memory
+        with open(self.path, 'rb') as file:
+            req = http_session().put(self.url, data=file)
 
         if req.status_code < 200 or req.status_code >= 300:
             logging.error('Got status code: %d', req.status_code)
             logging.error(req.text)
+            self.transient = req.status_code in TRANSIENT_HTTP_STATUS
             return 1
         logging.debug('OK, got status code: %d', req.status_code)
 
@@ -75,34 +351,40 @@ class HTTPTransput(Transput):
         return 1
 
 
-def copyContent(src, dst, symlinks=False, ignore=None):
+def preallocate(file, size):
     '''
-    https://stackoverflow.com/a/12514470/1553043
+    Reserves 'size' bytes on disk for 'file', so a large download fails early
+    when the volume is full and is laid out contiguously.
+    Filesystems without fallocate support are silently skipped.
+    '''
+
+    try:
+        os.posix_fallocate(file.fileno(), 0, size)
+    except (AttributeError, OSError) as err:
+        logging.debug('Could not preallocate %d bytes: %s', size, err)
+
+
+def copyContent(src, dst):
+    '''
+    Copies the entries of the directory 'src' into the existing directory 'dst'.
     '''
 
     for item in os.listdir(src):
         s = os.path.join(src, item)
         d = os.path.join(dst, item)
         if os.path.isdir(s):
-            shutil.copytree(s, d, symlinks, ignore)
+            copy_tree(s, d)
         else:
-            shutil.copy2(s, d)
+            copy_file(s, d)
 
 
 def copyDir(src, dst):
     '''
-    Limitation of shutil.copytree:
-
-    > The destination directory, named by dst, must not already exist; it will be created as well as missing parent directories.
+    Unlike shutil.copytree, 'dst' may already exist; the contents of 'src' are
+    merged into it.
     '''
 
-    if os.path.exists(dst):
-
-        copyContent(src, dst)
-
-    else:
-
-        shutil.copytree(src, dst)
+    copy_tree(src, dst)
 
 def copyFile(src, dst):
     '''
@@ -117,7 +399,7 @@ def copyFile(src, dst):
         dst=os.path.dirname(dst)
 
     for file in glob(src):
-        shutil.copy(file, dst)
+        copy_file(file, dst)
 
 
 class FileTransput(Transput):
@@ -130,50 +412,209 @@ class FileTransput(Transput):
         logging.debug("Copying {src} to {dst}".format(**locals()))
         copyFn(src, dst)
 
-    def download_file(self): self.transfer(shutil.copy  , self.urlContainerPath , self.path)
+    def output_check(self):
+        directory = self.urlContainerPath if self.ftype == Type.Directory \
+            else os.path.dirname(self.urlContainerPath)
+        # Missing directories are created by the upload
+        while not os.path.exists(directory):
+            directory = os.path.dirname(directory)
+        if not os.access(directory, os.W_OK):
+            logging.error('Unable to write to %s', directory)
+            return 1
+        return 0
+
+    def input_size(self):
+        # e.g. in the taskmaster, which does not mount the transfer volume
+        if not fileVolumeMounted():
+            return None, None
+        if os.path.isfile(self.urlContainerPath):
+            return os.path.getsize(self.urlContainerPath), 1
+        if not os.path.isdir(self.urlContainerPath):
+            raise FileNotFoundError(self.urlContainerPath)
+        size, files = 0, 0
+        for root, _, names in os.walk(self.urlContainerPath):
+            for name in names:
+                size += os.path.getsize(os.path.join(root, name))
+                files += 1
+        return size, files
+
+    def download_file(self): self.transfer(copy_file    , self.urlContainerPath , self.path)
     def download_dir(self):  self.transfer(copyDir      , self.urlContainerPath , self.path)
     def upload_file(self):   self.transfer(copyFile  , self.path             , self.urlContainerPath)
     def upload_dir(self):    self.transfer(copyDir      , self.path             , self.urlContainerPath)
 
 
+class FTPConnectionPool:
+    '''
+    Logged-in FTP connections of the filer run, kept per host so that
+    transfers to the same server reuse them instead of connecting and
+    logging in for every file.
+
+    FILER_FTP_MAX_CONNECTIONS caps the connections open to one server at
+    a time; unset means no cap.
+    '''
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.idle = {}
+        self.opened = {}
+
+    def acquire(self, netloc, netrc_file, block=True):
+        '''
+        Returns an idle connection to 'netloc' that still answers a NOOP, or a
+        new logged-in one if there is none. When the server's connection cap
+        is reached, waits for a connection to be released, or returns None
+        if 'block' is False.
+        '''
+        limit = env_int('FILER_FTP_MAX_CONNECTIONS')
+        while True:
+            with self.condition:
+                while not self.idle.get(netloc) and limit is not None and \
+                        self.opened.get(netloc, 0) >= limit:
+                    if not block:
+                        return None
+                    self.condition.wait()
+                connections = self.idle.get(netloc)
+                ftp_connection = connections.pop() if connections else None
+                if ftp_connection is None:
+                    self.opened[netloc] = self.opened.get(netloc, 0) + 1
+                    break
+            try:
+                ftp_connection.voidcmd('NOOP')
+                return ftp_connection
+            except ftplib.all_errors:
+                logging.debug('Dropping stale FTP connection to %s', netloc)
+                ftp_connection.close()
+                self.forget(netloc)
+
+        try:
+            ftp_connection = FTP()
+            ftp_connection.connect(netloc)
+            ftp_login(ftp_connection, netloc, netrc_file)
+        except Exception:
+            self.forget(netloc)
+            raise
+        return ftp_connection
+
+    def release(self, netloc, ftp_connection):
+        with self.condition:
+            self.idle.setdefault(netloc, []).append(ftp_connection)
+            self.condition.notify()
+
+    def forget(self, netloc):
+        with self.condition:
+            self.opened[netloc] -= 1
+            self.condition.notify()
+
+    def close_all(self):
+        with self.condition:
+            idle, self.idle = self.idle, {}
+            for netloc, connections in idle.items():
+                self.opened[netloc] -= len(connections)
+        for connections in idle.values():
+            for ftp_connection in connections:
+                try:
+                    ftp_connection.quit()
+                except ftplib.all_errors:
+                    ftp_connection.close()
+
+
+ftp_pool = FTPConnectionPool()
+
+
 class FTPTransput(Transput):
     def __init__(self, path, url, ftype, ftp_conn=None):
         Transput.__init__(self, path, url, ftype)
 
         self.connection_owner = ftp_conn is None
-        self.ftp_connection = FTP() if ftp_conn is None else ftp_conn
+        self.ftp_connection = ftp_conn
 
     # entice users to use contexts when using this class
     def __enter__(self):
         if self.connection_owner:
-            self.ftp_connection.connect(self.netloc)
-            ftp_login(self.ftp_connection, self.netloc, self.netrc_file)
+            self.ftp_connection = ftp_pool.acquire(self.netloc, self.netrc_file)
         return self
 
     def upload_dir(self):
-        for file in os.listdir(self.path):
-            file_path = self.path + '/' + file
-            file_url = self.url + '/' + file
-
-            if os.path.isdir(file_path):
-                ftype = Type.Directory
-            elif os.path.isfile(file_path):
-                ftype = Type.File
-            else:
-                logging.error(
-                    'Directory listing in is neither file nor directory: "%s"',
-                    file_url
-                )
-                return 1
-
-            logging.debug('Uploading %s\t"%s"', ftype.value, file_path)
-
-            # We recurse into new transputs, ending with files which are uploaded
-            # Downside is nothing happens with empty dirs.
-            with FTPTransput(file_path, file_url, ftype) as transfer:
-                if transfer.upload():
+        files = []
+        for root, dirs, names in os.walk(self.path, followlinks=True):
+            dirs.sort()
+            for name in sorted(names):
+                file_path = os.path.join(root, name)
+                file_url = self.url + '/' + os.path.relpath(file_path, self.path)
+
+                if not os.path.isfile(file_path):
+                    logging.error(
+                        'Directory listing in is neither file nor directory: "%s"',
+                        file_url
+                    )
                     return 1
-        return 0
+                files.append((file_path, file_url))
+
+        # Downside is nothing happens with empty dirs.
+        return self.transfer_files(files, FTPTransput.upload)
+
+    def destination_unchanged(self):
+        '''
+        The remote file is taken to be unchanged if SIZE reports the local
+        size and MDTM a modification time no older than the local file. FTP
+        has no standard content hash, so this only holds for files this run
+        already uploaded: outputs rewritten by a rerun are newer and sent again.
+        '''
+        try:
+            self.ftp_connection.voidcmd('TYPE I')
+            size = self.ftp_connection.size(self.url_path)
+            response = self.ftp_connection.voidcmd('MDTM ' + self.url_path)
+        except ftplib.all_errors:
+            return False
+        if size != os.path.getsize(self.path):
+            return False
+        try:
+            modified = datetime.strptime(response.split()[1][:14], '%Y%m%d%H%M%S')
+        except (IndexError, ValueError):
+            return False
+        return modified.replace(tzinfo=timezone.utc).timestamp() >= int(os.path.getmtime(self.path))
+
+    def output_check(self):
+        # Logging in (in __enter__) checked the credentials, unless the server let
+        # a rejected user in anonymously. Missing directories are created by the
+        # upload, so the deepest existing one must be usable.
+        if getattr(self.ftp_connection, 'login_rejected', False) is True:
+            logging.error('The configured FTP user was rejected by %s', self.netloc)
+            return 1
+        directory = self.url_path if self.ftype == Type.Directory \
+            else os.path.dirname(self.url_path)
+        for candidate in reversed(['/'] + subfolders_in(directory)):
+            try:
+                self.ftp_connection.cwd(candidate)
+                return 0
+            except ftplib.error_perm:
+                continue
+        logging.error('Unable to change into any directory of %s', self.url)
+        return 1
+
+    def input_size(self):
+        try:
+            if self.ftype == Type.Directory:
+                files = list(self.remote_files(self.url_path, self.path, self.url))
+                if any(size is None for _, _, size in files):
+                    return None, None
+                return sum(size for _, _, size in files), len(files)
+            self.ftp_connection.voidcmd('TYPE I')
+            return self.ftp_connection.size(self.url_path), 1
+        except ftplib.error_perm as err:
+            if str(err).startswith('550'):
+                raise FileNotFoundError(str(err))
+            return None, None
+
+    def cache_validator(self):
+        try:
+            self.ftp_connection.voidcmd('TYPE I')
+            size = self.ftp_connection.size(self.url_path)
+            response = self.ftp_connection.voidcmd('MDTM ' + self.url_path)
+        except ftplib.all_errors:
+            return None
+        return '{} {}'.format(response.split()[-1], size)
 
     def upload_file(self):
         error = ftp_make_dirs(self.ftp_connection,
@@ -192,38 +633,76 @@ class FTPTransput(Transput):
 
     def download_dir(self):
         logging.debug('Processing ftp dir: %s target: %s', self.url, self.path)
-        self.ftp_connection.cwd(self.url_path)
-
-        # This is horrible and I'm sorry but it works flawlessly.
-        # Credit to Chris Haas for writing this
-        # See https://stackoverflow.com/questions/966578/parse-response-from-ftp-list-command-syntax-variations
-        # for attribution
-        ftp_command = re.compile(
-            r'^(?P<dir>[\-ld])(?P<permission>([\-r][\-w][\-xs]){3})\s+(?P<filecode>\d+)\s+(?P<owner>\w+)\s+(?P<group>\w+)\s+(?P<size>\d+)\s+(?P<timestamp>((\w{3})\s+(\d{2})\s+(\d{1,2}):(\d{2}))|((\w{3})\s+(\d{1,2})\s+(\d{4})))\s+(?P<name>.+)$')
 
-        lines = []
-        self.ftp_connection.retrlines('LIST', lines.append)
-
-        for line in lines:
-            matches = ftp_command.match(line)
-            dirbit = matches.group('dir')
-            name = matches.group('name')
-
-            file_path = self.path + '/' + name
-            file_url = self.url + '/' + name
+        # Largest files first, so they do not end up last on one connection
+        files = sorted(self.remote_files(self.url_path, self.path, self.url),
+                       key=lambda file: file[2] or 0, reverse=True)
+
+        # Downside is nothing happens with empty dirs.
+        return self.transfer_files([(file_path, file_url)
+                                    for file_path, file_url, _ in files],
+                                   FTPTransput.download)
+
+    def remote_files(self, url_path, path, url):
+        '''
+        Walks the remote directory 'url_path', yielding a
+        (local path, url, size) tuple for every file below it.
+        '''
+        for entry in ftp_list_dir(self.ftp_connection, url_path):
+            if entry.is_dir:
+                yield from self.remote_files(url_path + '/' + entry.name,
+                                             path + '/' + entry.name,
+                                             url + '/' + entry.name)
+            else:
+                yield path + '/' + entry.name, url + '/' + entry.name, entry.size
+
+    def transfer_files(self, files, transfer):
+        '''
+        Runs 'transfer' (FTPTransput.download or upload) for every
+        (local path, url) pair of 'files'. The files are shared out over
+        this transput's connection plus up to FILER_FTP_CONNECTIONS - 1 more
+        from the pool, as far as the server's connection cap allows.
+        '''
+        connections = [self.ftp_connection]
+        for _ in range(min(env_int('FILER_FTP_CONNECTIONS', 1), len(files)) - 1):
+            ftp_connection = ftp_pool.acquire(self.netloc, self.netrc_file, block=False)
+            if ftp_connection is None:
+                break
+            connections.append(ftp_connection)
+
+        todo = iter(files)
+        lock = threading.Lock()
+        failed = threading.Event()
+
+        def worker(ftp_connection):
+            while not failed.is_set():
+                with lock:
+                    file_path, file_url = next(todo, (None, None))
+                if file_path is None:
+                    return
+                logging.debug('Transferring file\t"%s"', file_path)
+                with FTPTransput(file_path, file_url, Type.File,
+                                 ftp_connection) as transput:
+                    try:
+                        if transfer(transput):
+                            failed.set()
+                    except Exception:
+                        failed.set()
+                        raise
 
-            if dirbit == 'd':
-                ftype = Type.Directory
+        try:
+            if len(connections) == 1:
+                worker(self.ftp_connection)
             else:
-                ftype = Type.File
+                logging.debug('Transferring %d files over %d connections',
+                              len(files), len(connections))
+                with ThreadPoolExecutor(max_workers=len(connections)) as executor:
+                    list(executor.map(worker, connections))
+        finally:
+            for ftp_connection in connections[1:]:
+                ftp_pool.release(self.netloc, ftp_connection)
 
-            # We recurse into new transputs, ending with files which are downloaded
-            # Downside is nothing happens with empty dirs.
-            with FTPTransput(file_path, file_url, ftype,
-                             self.ftp_connection) as transfer:
-                if transfer.download():
-                    return 1
-        return 0
+        return 1 if failed.is_set() else 0
 
     def download_file(self):
         logging.debug('Downloading ftp file: "%s" Target: %s', self.url,
@@ -231,11 +710,27 @@ class FTPTransput(Transput):
         basedir = os.path.dirname(self.path)
         distutils.dir_util.mkpath(basedir)
 
-        return ftp_download_file(self.ftp_connection, self.url_path, self.path)
+        if not resumable():
+            return ftp_download_file(self.ftp_connection, self.url_path, self.path)
+
+        # REST cannot tell versions apart, so the partial file is only appended
+        # to while the file keeps the modification time and size it had
+        validator = self.cache_validator()
+        offset = resume_offset(self.path, validator)
+        if offset:
+            logging.info('Resuming download of %s at byte %d', self.url, offset)
+        else:
+            start_partial(self.path, validator)
+        if ftp_download_file(self.ftp_connection, self.url_path,
+                             partial_path(self.path), offset):
+            return 1
+        finish_partial(self.path)
+        return 0
 
     def delete(self):
-        if self.connection_owner:
-            self.ftp_connection.close()
+        if self.connection_owner and self.ftp_connection is not None:
+            ftp_pool.release(self.netloc, self.ftp_connection)
+            self.ftp_connection = None
 
 
 def ftp_login(ftp_connection, netloc, netrc_file):
@@ -253,16 +748,111 @@ def ftp_login(ftp_connection, netloc, netrc_file):
         try:
             ftp_connection.login(user, password)
         except ftplib.error_perm:
+            logging.warning('Login to %s as %s rejected, logging in anonymously', netloc, user)
+            # Checked by FTPTransput.output_check
+            ftp_connection.login_rejected = True
             ftp_connection.login()
     else:
         ftp_connection.login()
 
 
+FTPEntry = collections.namedtuple('FTPEntry', ['name', 'is_dir', 'size', 'modify'])
+
+# This is horrible and I'm sorry but it works flawlessly.
+# Credit to Chris Haas for writing this
+# See https://stackoverflow.com/questions/966578/parse-response-from-ftp-list-command-syntax-variations
+# for attribution
+ftp_list_line = re.compile(
+    r'^(?P<dir>[\-ld])(?P<permission>([\-r][\-w][\-xs]){3})\s+(?P<filecode>\d+)\s+(?P<owner>\w+)\s+(?P<group>\w+)\s+(?P<size>\d+)\s+(?P<timestamp>((\w{3})\s+(\d{2})\s+(\d{1,2}):(\d{2}))|((\w{3})\s+(\d{1,2})\s+(\d{4})))\s+(?P<name>.+)$')
+
+
+def ftp_list_dir(ftp_connection, path):
+    """
+    Lists the remote directory 'path' as FTPEntry tuples.
+
+    Uses MLSD, whose machine-readable facts give the type, size and
+    modification time of every entry without changing directory. Servers
+    that do not support it are listed with LIST instead, where 'modify'
+    is unknown (None).
+    """
+    if not getattr(ftp_connection, 'mlsd_unsupported', False):
+        entries = []
+
+        def parse_mlsd(line):
+            facts_found, _, name = line.rstrip('\r\n').partition(' ')
+            facts = {}
+            for fact in facts_found[:-1].split(';'):
+                key, _, value = fact.partition('=')
+                facts[key.lower()] = value
+            kind = facts.get('type', '').lower()
+            if kind in ('cdir', 'pdir') or name in ('.', '..'):
+                return
+            size = facts.get('size')
+            entries.append(FTPEntry(name, kind == 'dir',
+                                    int(size) if size and size.isdigit() else None,
+                                    facts.get('modify')))
+        try:
+            ftp_connection.retrlines('MLSD ' + (path or '.'), parse_mlsd)
+            return entries
+        except ftplib.error_perm as err:
+            if not str(err).startswith(('500', '501', '502')):
+                raise
+            logging.debug('MLSD not supported by %s, falling back to LIST',
+                          ftp_connection.host)
+            # Remembered on the connection, to not ask again for every directory
+            ftp_connection.mlsd_unsupported = True
+
+    ftp_connection.cwd(path)
+
+    entries = []
+
+    def parse_list(line):
+        matches = ftp_list_line.match(line)
+        if matches is None:
+            logging.warning('Skipping unrecognised LIST line: "%s"', line)
+            return
+        entries.append(FTPEntry(matches.group('name'), matches.group('dir') == 'd',
+                                int(matches.group('size')), None))
+
+    ftp_connection.retrlines('LIST', parse_list)
+    return entries
+
+
+class FTPDirCache:
+    """
+    Remote directories known to exist ('known') and the subset of them this
+    filer created itself ('created', so empty when created), per connection.
+    """
+
+    def __init__(self):
+        self.known = set()
+        self.created = set()
+
+
+def ftp_dir_cache(ftp_connection):
+    cache = getattr(ftp_connection, 'dir_cache', None)
+    if not isinstance(cache, FTPDirCache):
+        cache = FTPDirCache()
+        ftp_connection.dir_cache = cache
+    return cache
+
+
 def ftp_check_directory(ftp_connection, path):
     """
     Following convention with the rest of the code,
     return 0 if it is a directory, 1 if it is not or failed to do the check
     """
+    cache = ftp_dir_cache(ftp_connection)
+    if path in cache.known:
+        logging.error(
+            'Path "%s" at "%s" already exists and is a folder. \
+            Please specify a target filename and retry',
+            path, ftp_connection.host)
+        return 0
+    # Nothing but what we put there can be in a directory we created
+    if os.path.dirname(path) in cache.created:
+        return 1
+
     response = ftp_connection.pwd()
     if response == '':
         return 1
@@ -299,7 +889,7 @@ def ftp_upload_file(ftp_connection, local_source_path,
     try:
         with open(local_source_path, 'r+b') as file:
             ftp_connection.storbinary("STOR /" + remote_destination_path, file)
-    except (ftplib.error_reply, ftplib.error_perm, ftplib.error_temp):
+    except (ftplib.error_reply, ftplib.error_perm):
         logging.exception(
             'Unable to upload file "%s" to "%s" as "%s"',
             local_source_path,
@@ -310,11 +900,19 @@ def ftp_upload_file(ftp_connection, local_source_path,
 
 
 def ftp_download_file(ftp_connection, remote_source_path,
-                      local_destination_path):
+                      local_destination_path, offset=0):
+    '''
+    With an 'offset' the file is appended to from there on, using REST.
+    '''
     try:
-        with open(local_destination_path, 'w+b') as file:
-            ftp_connection.retrbinary("RETR " + remote_source_path, file.write)
-    except (ftplib.error_reply, ftplib.error_perm, ftplib.error_temp):
+        if offset:
+            with open(local_destination_path, 'ab') as file:
+                ftp_connection.retrbinary("RETR " + remote_source_path,
+                                          file.write, rest=offset)
+        else:
+            with open(local_destination_path, 'w+b') as file:
+                ftp_connection.retrbinary("RETR " + remote_source_path, file.write)
+    except (ftplib.error_reply, ftplib.error_perm):
         logging.exception(
             'Unable to download file "%s" from "%s" as "%s"',
             remote_source_path,
@@ -350,43 +948,32 @@ def subfolders_in(whole_path):
 
 
 def ftp_make_dirs(ftp_connection, path):
-    response = ftp_connection.pwd()
-    if response == '':
-        return 1
-    original_directory = response
+    """
+    Creates the remote directory 'path' and its missing parents, top down,
+    with one MKD per directory not yet known to exist on this connection.
+    A refused MKD is taken to mean the directory already exists; if it
+    does not, the upload into it reports the error.
+    """
+    if not path.strip('/'):
+        return 0
 
-    # if directory exists do not do anything else
-    try:
-        ftp_connection.cwd(path)
+    cache = ftp_dir_cache(ftp_connection)
+    if path in cache.known:
         return 0
-    except (ftplib.error_perm, ftplib.error_temp):
-        pass
-    except ftplib.error_reply:
-        logging.exception('Unable to create directory "%s" at "%s"',
-                          path, ftp_connection.host)
-        return 1
 
     for subfolder in subfolders_in(path):
+        if subfolder in cache.known:
+            continue
         try:
-            ftp_connection.cwd(subfolder)
-        except (ftplib.error_perm, ftplib.error_temp):
-            try:
-                ftp_connection.mkd(subfolder)
-            except (ftplib.error_reply, ftplib.error_perm, ftplib.error_temp):
-                logging.exception('Unable to create directory "%s" at "%s"',
-                                  subfolder, ftp_connection.host)
-                return 1
-        except ftplib.error_reply:
+            ftp_connection.mkd(subfolder)
+            cache.created.add(subfolder)
+        except ftplib.error_perm:
+            pass
+        except (ftplib.error_reply, ftplib.error_temp):
             logging.exception('Unable to create directory "%s" at "%s"',
-                              path, ftp_connection.host)
+                              subfolder, ftp_connection.host)
             return 1
-
-    try:
-        ftp_connection.cwd(original_directory)
-    except (ftplib.error_reply, ftplib.error_perm, ftplib.error_temp):
-        logging.exception('Unable to create directory "%s" at "%s"',
-                          path, ftp_connection.host)
-        return 1
+        cache.known.add(subfolder)
     return 0
 
 
@@ -438,15 +1025,68 @@ def process_file(ttype, filedata):
 
     trans = newTransput(scheme, netloc)
 
-    with trans(filedata['path'], filedata['url'],
-               Type(filedata['type'])) as transfer:
-        if ttype == 'inputs':
-            return transfer.download()
-        if ttype == 'outputs':
-            return transfer.upload()
+    def transfer_once():
+        with trans(filedata['path'], filedata['url'],
+                   Type(filedata['type'])) as transfer:
+            if ttype == 'inputs':
+                cache = input_cache()
+                if cache is not None and transfer.ftype == Type.File:
+                    return cache.fetch(transfer), transfer.transient
+                return transfer.download(), transfer.transient
+            if ttype == 'outputs':
+                return transfer.upload(), transfer.transient
 
-    logging.info('There was no action to do with %s', filedata['path'])
-    return 0
+        logging.info('There was no action to do with %s', filedata['path'])
+        return 0, False
+
+    return retrying(transfer_once, filedata['url'])
+
+
+def input_size(filedata, same_credentials=True):
+    '''
+    (bytes, files) of the input 'filedata', see Transput.input_size.
+
+    Servers commonly answer "not found" for what the caller may not see. So
+    unless the probe runs with the credentials the filer will use
+    ('same_credentials'), inputs not found are of unknown size rather than
+    missing.
+    '''
+
+    if 'content' in filedata:
+        return len(str(filedata['content'])), 1
+    parsed_url = urlparse(filedata['url'])
+    trans = newTransput(parsed_url.scheme or 'file', parsed_url.netloc)
+    try:
+        with trans(filedata['path'], filedata['url'],
+                   Type(filedata['type'])) as transfer:
+            return transfer.input_size()
+    except SystemExit:
+        # S3Transput exits when the bucket cannot be accessed
+        return None, None
+    except FileNotFoundError as err:
+        if same_credentials:
+            raise
+        logging.debug('%s not found without the filer credentials: %s', filedata['url'], err)
+        return None, None
+
+
+def output_check(filedata):
+    '''
+    Pre-flight check of the destination of the output 'filedata', see
+    Transput.output_check.
+    '''
+
+    if 'content' in filedata:
+        return 0
+    parsed_url = urlparse(filedata['url'])
+    trans = newTransput(parsed_url.scheme or 'file', parsed_url.netloc)
+    try:
+        with trans(filedata['path'], filedata['url'],
+                   Type(filedata['type'])) as transfer:
+            return transfer.output_check()
+    except SystemExit:
+        # S3Transput exits when the bucket cannot be accessed
+        return 1
 
 
 def logConfig(loglevel):
@@ -470,6 +1110,10 @@ def main():
         '-d',
         help='debug logging',
         action='store_true')
+    parser.add_argument(
+        '--plan',
+        help='only report the size of the inputs, as JSON, without transferring them',
+        action='store_true')
     args = parser.parse_args()
 
     if args.debug:
@@ -487,14 +1131,56 @@ def main():
     else:
         data = json.loads(args.data)
 
-    for afile in data[args.transputtype]:
-        logging.debug('Processing file: %s', afile['path'])
-        if process_file(args.transputtype, afile):
-            logging.error('Unable to process file, aborting')
+    transfers = data[args.transputtype]
+    if args.transputtype == 'inputs':
+        # These are mounted straight from the transfer volume by the taskmaster
+        for filedata in transfers:
+            if directInput(filedata):
+                logging.info('Not copying %s, it is mounted directly', filedata['url'])
+        transfers = [filedata for filedata in transfers if not directInput(filedata)]
+
+    # With FILER_PLAN_INPUTS set, missing inputs fail the filer before any download
+    if args.transputtype == 'inputs' and (args.plan or env_int('FILER_PLAN_INPUTS', 0)):
+        plan = plan_transfers(transfers, input_size, workers=env_int('FILER_WORKERS', 4))
+        if args.plan:
+            print(json.dumps({'bytes': plan.bytes, 'files': plan.files, 'unknown': plan.unknown,
+                              'missing': [filedata.get('url') for filedata in plan.missing]}))
+        if plan.missing:
+            logging.error('Missing inputs, aborting')
             return 1
-        logging.debug('Processed file: %s', afile['path'])
+        if args.plan:
+            return 0
+
+    process = process_file
+    if resumable():
+        process = Manifest(os.path.join(os.environ['FILER_CHECKPOINT_DIR'],
+                                        args.transputtype + '.manifest')).wrap(process_file)
+
+    # With FILER_PREFLIGHT_OUTPUTS set, the inputs filer checks the output
+    # destinations while downloading, so that a task unable to upload its
+    # results fails before its executors run
+    preflight = None
+    if args.transputtype == 'inputs' and env_int('FILER_PREFLIGHT_OUTPUTS', 0) \
+            and data.get('outputs'):
+        preflight_executor = ThreadPoolExecutor(max_workers=1)
+        preflight = preflight_executor.submit(check_destinations, data['outputs'],
+                                              output_check)
+        preflight_executor.shutdown(wait=False)
 
-    return 0
+    try:
+        result = run_transfers(args.transputtype, transfers, process,
+                               workers=env_int('FILER_WORKERS', 4),
+                               per_host=env_int('FILER_WORKERS_PER_HOST'))
+        if result:
+            logging.error('Unable to process file, aborting')
+        if preflight is not None and preflight.result():
+            logging.error('Output destinations failed their pre-flight checks, aborting')
+            result = 1
+    finally:
+        ftp_pool.close_all()
+        shutdown_transfer_managers()
+
+    return result
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 import json
+import os
 from tesk_core import path
 from tesk_core.path import fileEnabled
 
@@ -73,6 +74,12 @@ class Filer:
             })
 
         self.add_s3_mount()
+        self.add_tuning_env()
+
+        cache_host_path = os.environ.get('FILER_CACHE_HOST_PATH')
+        cache_claim_name = os.environ.get('FILER_CACHE_PVC')
+        if cache_host_path or cache_claim_name:
+            self.add_cache_mount(cache_host_path, cache_claim_name)
 
     def add_s3_mount(self):
         """ Mounts the s3 configuration file. The secret name is hardcoded and
@@ -115,6 +122,31 @@ class Filer:
             }
         )
 
+    def add_cache_mount(self, host_path=None, claim_name=None, mount_path='/cache'):
+        """ Mounts the input cache shared between tasks (see tesk_core.cache),
+            either a directory of the node ('host_path') or a ReadWriteMany
+            volume ('claim_name'), and points the filer at it.
+        """
+
+        self.getVolumeMounts().append({"name": "input-cache", "mountPath": mount_path})
+        volume = {"name": "input-cache"}
+        if host_path:
+            volume["hostPath"] = {"path": host_path, "type": "DirectoryOrCreate"}
+        else:
+            volume["persistentVolumeClaim"] = {"claimName": claim_name}
+        self.getVolumes().append(volume)
+        self.getEnv().append({"name": "FILER_CACHE_DIR", "value": mount_path})
+
+    def add_tuning_env(self):
+        """ Passes the filer settings of the taskmaster (environment variables
+            starting with 'FILER_', e.g. 'FILER_HTTP_CHUNK_SIZE') on to the filer.
+        """
+
+        env = self.getEnv()
+        for name, value in sorted(os.environ.items()):
+            if name.startswith('FILER_'):
+                env.append({"name": name, "value": value})
+
     def set_ftp(self, user, pw):
         env = self.getEnv()
         env.append({"name": "TESK_FTP_USERNAME", "value": user})
@@ -135,6 +167,19 @@ class Filer:
                                   "persistentVolumeClaim": {
                                       "claimName": pvc.name}})
 
+    def add_checkpoint_mount(self, mount_path='/checkpoint'):
+        """ Mounts a directory of the task volume into the filer for the
+            manifests of resumable transfers (see tesk_core.checkpoint), so
+            that a restarted filer pod picks up where the last one stopped.
+            The task volume must already be mounted, see add_volume_mount.
+        """
+
+        self.getVolumeMounts().append({"name"      : "task-volume",
+                                       "mountPath" : mount_path,
+                                       "subPath"   : "filer-checkpoint"
+                                      })
+        self.getEnv().append({"name": "FILER_CHECKPOINT_DIR", "value": mount_path})
+
 
     def add_netrc_mount(self, netrc_name='netrc'):
         '''
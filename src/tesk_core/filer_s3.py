@@ -1,10 +1,194 @@
 import sys
 import os
+import hashlib
 import logging
 import re
+import threading
 import botocore
 import boto3
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
 from tesk_core.transput import Transput, Type
+from tesk_core.Util import env_int
+from tesk_core.retry import is_transient
+from tesk_core.checkpoint import resumable, partial_path, finish_partial, start_partial, \
+    resume_offset, discard_partial
+
+MB = 1024 * 1024
+
+# boto3 sessions are not thread safe, so clients are only built under this lock
+_s3_lock = threading.Lock()
+_s3_endpoint = None
+# Only the low-level clients of these are shared, see s3_resource
+_s3_resources = {}
+_s3_transfer_managers = {}
+_verified_buckets = set()
+
+
+def s3_session():
+    with _s3_lock:
+        if boto3.DEFAULT_SESSION is None:
+            boto3.setup_default_session()
+        return boto3.DEFAULT_SESSION
+
+
+def s3_endpoint():
+    '''
+    The default S3 endpoint of the configured region, looked up once per run.
+    '''
+    global _s3_endpoint
+    session = s3_session()
+    with _s3_lock:
+        if _s3_endpoint is None:
+            _s3_endpoint = session.client('s3').meta.endpoint_url
+        return _s3_endpoint
+
+
+def s3_resource(endpoint_url):
+    '''
+    Returns a new S3 resource for 'endpoint_url' and the configured
+    credentials. Resources are not thread safe, so every transfer gets its
+    own, but they all share one low-level client, which is: the client is
+    built (and its connections opened) only once per filer run.
+    '''
+    session = s3_session()
+    credentials = session.get_credentials()
+    key = (endpoint_url, credentials.access_key if credentials else None)
+    with _s3_lock:
+        if key not in _s3_resources:
+            _s3_resources[key] = session.resource('s3', endpoint_url=endpoint_url)
+        shared = _s3_resources[key]
+    return type(shared)(client=shared.meta.client)
+
+
+def s3_transfer_config(size=None):
+    '''
+    The TransferConfig applied to every S3 transfer, tunable with:
+
+    FILER_S3_WORKERS                concurrent requests (default 10)
+    FILER_S3_MULTIPART_CHUNKSIZE    part size of multipart transfers and ranged GETs
+    FILER_S3_MULTIPART_THRESHOLD    size from which files are split into parts
+                                    (default: the part size)
+    FILER_S3_MAX_IO_QUEUE           downloaded parts waiting to be written (default 100)
+    FILER_S3_USE_THREADS            0 to transfer in the calling thread only
+
+    Without an explicit part size, parts are 8 MiB, or for objects of known
+    'size' large enough to keep them at no more than 1000 parts (up to the
+    5 GiB S3 allows), so huge objects do not cost tens of thousands of requests.
+    '''
+    chunksize = env_int('FILER_S3_MULTIPART_CHUNKSIZE')
+    if chunksize is None:
+        chunksize = 8 * MB
+        if size:
+            chunksize = min(max(chunksize, -(-size // 1000)), 5 * 1024 * MB)
+
+    return TransferConfig(
+        max_concurrency=env_int('FILER_S3_WORKERS', 10),
+        multipart_threshold=env_int('FILER_S3_MULTIPART_THRESHOLD', chunksize),
+        multipart_chunksize=chunksize,
+        max_io_queue=env_int('FILER_S3_MAX_IO_QUEUE', 100),
+        use_threads=env_int('FILER_S3_USE_THREADS', 1) != 0)
+
+
+def s3_etag(path, chunksize=None):
+    '''
+    The ETag S3 gives the file at 'path': its MD5 when uploaded whole, or
+    when uploaded in parts of 'chunksize' bytes the MD5 of the parts' MD5s
+    followed by the number of parts.
+    '''
+    if chunksize is None:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(MB), b''):
+                md5.update(block)
+        return md5.hexdigest()
+
+    md5s = []
+    with open(path, 'rb') as file:
+        for part in iter(lambda: file.read(chunksize), b''):
+            md5s.append(hashlib.md5(part).digest())
+    return '{}-{}'.format(hashlib.md5(b''.join(md5s)).hexdigest(), len(md5s))
+
+
+def s3_unchanged(path, size, etag):
+    '''
+    Whether an object of 'size' bytes with 'etag' matches the file at 'path'.
+    Multipart ETags are recomputed with the part sizes this filer uploads
+    with (for single files and for directories); other part sizes never match.
+    '''
+    if size != os.path.getsize(path):
+        return False
+    etag = etag.strip('"')
+    if '-' not in etag:
+        return etag == s3_etag(path)
+    parts = etag.split('-')[1]
+    for chunksize in {s3_transfer_config(size).multipart_chunksize,
+                      s3_transfer_config().multipart_chunksize}:
+        if str(-(-size // chunksize)) == parts and etag == s3_etag(path, chunksize):
+            return True
+    return False
+
+
+def s3_transfer_manager(client):
+    '''
+    Returns the s3transfer manager shared by every transfer made with
+    'client', configured by s3_transfer_config. It runs at most
+    FILER_S3_WORKERS requests at a time, whatever the number of files
+    queued on it.
+    '''
+    with _s3_lock:
+        if client not in _s3_transfer_managers:
+            _s3_transfer_managers[client] = create_transfer_manager(client, s3_transfer_config())
+        return _s3_transfer_managers[client]
+
+
+def shutdown_transfer_managers():
+    with _s3_lock:
+        managers = list(_s3_transfer_managers.values())
+        _s3_transfer_managers.clear()
+    for manager in managers:
+        manager.shutdown()
+
+
+def list_s3_objects(client, bucket, prefix):
+    '''
+    Yields every object under 'prefix', following the listing past its
+    1000-object pages.
+    '''
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    while True:
+        page = client.list_objects_v2(**kwargs)
+        yield from page.get('Contents', [])
+        if not page.get('IsTruncated'):
+            return
+        kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+
+def wait_for_transfers(futures, transput=None):
+    '''
+    Waits for the s3transfer 'futures'. On the first failure the ones not
+    started yet are cancelled, 'transput' is told whether the failure is
+    transient, and 1 is returned.
+    '''
+    for i, future in enumerate(futures):
+        try:
+            future.result()
+        except botocore.exceptions.ClientError as err:
+            logging.error('Got status code: %s', err.response['Error']['Code'])
+            logging.error(err.response['Error']['Message'])
+            failure = err
+        except (OSError, botocore.exceptions.BotoCoreError) as err:
+            logging.error(err)
+            failure = err
+        else:
+            continue
+        # 'err' is unbound once its except block is left
+        if transput is not None:
+            transput.transient = is_transient(failure)
+        for pending in futures[i + 1:]:
+            pending.cancel()
+        return 1
+    return 0
+
 
 class S3Transput(Transput):
     def __init__(self, path, url, ftype):
@@ -13,16 +197,20 @@ class S3Transput(Transput):
         self.bucket_obj = None
 
     def __enter__(self):
-        client = boto3.resource('s3', endpoint_url=self.extract_endpoint())
+        client = s3_resource(self.extract_endpoint())
         if self.check_if_bucket_exists(client):
             sys.exit(1)
         self.bucket_obj = client.Bucket(self.bucket)
         return self
 
     def extract_endpoint(self):
-        return boto3.client('s3').meta.endpoint_url
+        return s3_endpoint()
 
     def check_if_bucket_exists(self, client):
+        # Buckets that passed the check once are not checked again this run
+        bucket_key = (client.meta.client.meta.endpoint_url, self.bucket)
+        if bucket_key in _verified_buckets:
+            return 0
         try:
             client.meta.client.head_bucket(Bucket=self.bucket)
         except botocore.exceptions.ClientError as e:
@@ -32,6 +220,7 @@ class S3Transput(Transput):
             if e.response['Error']['Code'] == "404":
                 logging.error("Failed to fetch Bucket, reason: %s", e.response['Error']['Message'])
             return 1
+        _verified_buckets.add(bucket_key)
         return 0
 
     def get_bucket_name_and_file_path(self):
@@ -48,70 +237,197 @@ class S3Transput(Transput):
         logging.debug('Downloading s3 object: "%s" Target: %s', self.bucket + "/" + self.file_path, self.path)
         basedir = os.path.dirname(self.path)
         os.makedirs(basedir, exist_ok=True)
+        if resumable():
+            return self.resume_s3_file(self.path, self.file_path)
         return self.get_s3_file(self.path, self.file_path)
 
+    def destination_unchanged(self):
+        try:
+            obj = self.bucket_obj.Object(self.file_path)
+            return s3_unchanged(self.path, obj.content_length, obj.e_tag)
+        except (botocore.exceptions.ClientError, OSError):
+            return False
+
+    def input_size(self):
+        if self.ftype == Type.Directory:
+            prefix = self.file_path if self.file_path.endswith('/') else self.file_path + '/'
+            objects = list(list_s3_objects(self.bucket_obj.meta.client, self.bucket, prefix))
+            if not objects:
+                raise FileNotFoundError('No objects under ' + self.bucket + '/' + prefix)
+            return sum(obj['Size'] for obj in objects), len(objects)
+        try:
+            return self.bucket_obj.Object(self.file_path).content_length, 1
+        except botocore.exceptions.ClientError as err:
+            if err.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(self.bucket + '/' + self.file_path)
+            raise
+
+    def output_check(self):
+        # __enter__ checked the bucket. Starting a multipart upload takes the
+        # permission to write, but unlike a probe object it never shows up
+        # among the outputs, even if it cannot be aborted
+        probe = '/'.join(part for part in [self.file_path.strip('/'), '.tesk-preflight'] if part) \
+            if self.ftype == Type.Directory else self.file_path
+        client = self.bucket_obj.meta.client
+        try:
+            upload = client.create_multipart_upload(Bucket=self.bucket, Key=probe)
+        except botocore.exceptions.ClientError as err:
+            logging.error("Unable to write to '%s'", self.bucket + "/" + probe)
+            logging.error(err)
+            return 1
+        try:
+            client.abort_multipart_upload(Bucket=self.bucket, Key=probe,
+                                          UploadId=upload['UploadId'])
+        except botocore.exceptions.ClientError as err:
+            logging.warning("Unable to abort the probe upload to '%s': %s",
+                            self.bucket + "/" + probe, err)
+        return 0
+
+    def cache_validator(self):
+        try:
+            obj = self.bucket_obj.Object(self.file_path)
+            return '{} {} {}'.format(obj.version_id, obj.e_tag, obj.content_length)
+        except botocore.exceptions.ClientError:
+            return None
+
     def upload_file(self):
         logging.debug('Uploading s3 object: "%s" Target: %s', self.path,  self.bucket + "/" + self.file_path)
         try:
-            self.bucket_obj.upload_file(Filename=self.path, Key=self.file_path)
+            config = s3_transfer_config(os.path.getsize(self.path))
+            self.bucket_obj.upload_file(Filename=self.path, Key=self.file_path, Config=config)
         except (botocore.exceptions.ClientError,  OSError) as err:
             logging.error("File upload failed for '%s'", self.bucket + "/" + self.file_path)
             logging.error(err)
+            self.transient = is_transient(err)
             return 1
         return 0
 
     def upload_dir(self):
         logging.debug('Uploading s3 object: "%s" Target: %s', self.path, self.bucket + "/" + self.file_path)
+        manager = s3_transfer_manager(self.bucket_obj.meta.client)
+
+        def walk_error(err):
+            raise err
+
+        # The tree is walked once and every file queued on the shared transfer manager
+        futures = []
         try:
-            for item in os.listdir(self.path):
-                path = os.path.join(self.path,item)
-                if os.path.isdir(path):
-                    file_type = Type.Directory
-                elif os.path.isfile(path):
-                    file_type = Type.File
-                else:
-                    # An exception is raised, if the object type is neither file or directory
-                    logging.error("Object is neither file or directory : '%s' ",path)
-                    raise IOError
-                file_path = os.path.join(self.url, item)
-                with S3Transput(path, file_path, file_type) as transfer:
-                    if transfer.upload():
-                        return 1
-        except OSError as err:
+            # With FILER_SYNC_OUTPUTS, the prefix is listed once to skip unchanged files
+            existing = {}
+            if env_int('FILER_SYNC_OUTPUTS', 0):
+                prefix = self.file_path.strip('/')
+                existing = {obj['Key']: obj for obj in
+                            list_s3_objects(self.bucket_obj.meta.client, self.bucket,
+                                            prefix + '/' if prefix else '')}
+            for root, _, files in os.walk(self.path, onerror=walk_error, followlinks=True):
+                for item in files:
+                    path = os.path.join(root, item)
+                    if not os.path.isfile(path):
+                        # An exception is raised, if the object type is neither file or directory
+                        logging.error("Object is neither file or directory : '%s' ",path)
+                        raise IOError
+                    key = '/'.join(part for part in
+                                   [self.file_path.strip('/'), os.path.relpath(path, self.path)]
+                                   if part)
+                    if key in existing and \
+                            s3_unchanged(path, existing[key]['Size'], existing[key]['ETag']):
+                        logging.info('Skipping unchanged %s, already at %s', path, key)
+                        continue
+                    futures.append(manager.upload(path, self.bucket, key))
+        except (botocore.exceptions.ClientError, OSError) as err:
             logging.error("File upload failed for '%s'", self.bucket + "/" + self.file_path)
             logging.error(err)
+            self.transient = is_transient(err)
+            for future in futures:
+                future.cancel()
+            return 1
+
+        logging.debug('Uploading %d files', len(futures))
+        if wait_for_transfers(futures, self):
+            logging.error("File upload failed for '%s'", self.bucket + "/" + self.file_path)
             return 1
         return 0
 
     def download_dir(self):
         logging.debug('Downloading s3 object: "%s" Target: %s', self.bucket + "/" + self.file_path, self.path)
-        client = boto3.client('s3', endpoint_url=self.extract_endpoint())
+        client = self.bucket_obj.meta.client
+        manager = s3_transfer_manager(client)
         if not self.file_path.endswith('/'):
             self.file_path += '/'
-        objects = client.list_objects_v2(Bucket=self.bucket, Prefix=self.file_path)
 
-        # If the file path does not exists in s3 bucket, 'Contents' key will not be present in objects
-        if "Contents" not in objects:
+        # Objects are queued for download page by page while the listing goes on
+        futures = []
+        try:
+            for obj in list_s3_objects(client, self.bucket, self.file_path):
+                file_name = os.path.basename(obj["Key"])
+                dir_name = os.path.dirname(obj["Key"])
+                path_to_create = re.sub(r'^' + re.escape(self.file_path.strip('/')), "", dir_name).strip('/')
+                path_to_create = os.path.join(self.path, path_to_create)
+                os.makedirs(path_to_create, exist_ok=True)
+                futures.append(manager.download(self.bucket, obj["Key"],
+                                                os.path.join(path_to_create, file_name)))
+        except botocore.exceptions.ClientError as err:
+            logging.error('Got status code: %s', err.response['Error']['Code'])
+            logging.error(err.response['Error']['Message'])
+            self.transient = is_transient(err)
+            for future in futures:
+                future.cancel()
+            return 1
+
+        # If the file path does not exists in s3 bucket, there are no objects under it
+        if not futures:
             logging.error('Got status code: %s', 404)
             logging.error("Invalid file path!.")
             return 1
 
-        # Looping through the list of objects and downloading them
-        for obj in objects["Contents"]:
-            file_name = os.path.basename(obj["Key"])
-            dir_name = os.path.dirname(obj["Key"])
-            path_to_create = re.sub(r'^' + self.file_path.strip('/').replace('/', '\/') + '', "", dir_name).strip('/')
-            path_to_create = os.path.join(self.path, path_to_create)
-            os.makedirs(path_to_create, exist_ok=True)
-            if self.get_s3_file(os.path.join(path_to_create, file_name), obj["Key"]):
-                return 1
-        return 0
+        logging.debug('Downloading %d s3 objects', len(futures))
+        return wait_for_transfers(futures, self)
 
     def get_s3_file(self, file_name, key):
         try:
-            self.bucket_obj.download_file(Filename=file_name, Key=key)
+            config = s3_transfer_config(self.bucket_obj.Object(key).content_length)
+            self.bucket_obj.download_file(Filename=file_name, Key=key, Config=config)
+        except botocore.exceptions.ClientError as err:
+            logging.error('Got status code: %s', err.response['Error']['Code'])
+            logging.error(err.response['Error']['Message'])
+            self.transient = is_transient(err)
+            return 1
+        return 0
+
+    def resume_s3_file(self, file_name, key):
+        '''
+        Streams the object into a partial file, continuing with a ranged GET
+        from where an interrupted run left off, and renames it to 'file_name'
+        once complete. This is a single stream rather than a multipart
+        transfer, as s3transfer can only write whole files.
+
+        The partial file is only continued from the version (ETag) it was
+        started from, and every GET is made IfMatch that ETag, so a changed
+        object restarts the download instead of being spliced into it.
+        '''
+        try:
+            obj = self.bucket_obj.Object(key)
+            size = obj.content_length
+            offset = resume_offset(file_name, obj.e_tag)
+            if offset > size:
+                discard_partial(file_name)
+                offset = 0
+            if offset < size or not offset:
+                if offset:
+                    logging.info('Resuming download of %s at byte %d', key, offset)
+                    body = obj.get(Range='bytes={}-'.format(offset), IfMatch=obj.e_tag)['Body']
+                else:
+                    start_partial(file_name, obj.e_tag)
+                    body = obj.get(IfMatch=obj.e_tag)['Body']
+                with open(partial_path(file_name), 'ab' if offset else 'wb') as fh:
+                    for chunk in body.iter_chunks(chunk_size=MB):
+                        fh.write(chunk)
         except botocore.exceptions.ClientError as err:
             logging.error('Got status code: %s', err.response['Error']['Code'])
             logging.error(err.response['Error']['Message'])
+            # The object changed since its HEAD: the next attempt starts over
+            self.transient = is_transient(err) or \
+                err.response['Error']['Code'] in ('PreconditionFailed', '412')
             return 1
+        finish_partial(file_name)
         return 0
@@ -1,24 +1,102 @@
 import logging
 import time
 from datetime import datetime, timezone
-from kubernetes import client, config
+from kubernetes import client, config, watch
 from kubernetes.client.rest import ApiException
 from tesk_core.Util import pprint
 
 
 logging.basicConfig(format='%(message)s', level=logging.INFO)
+
+# Container waiting reasons no amount of waiting will fix
+HOPELESS_WAITING_REASONS = ('InvalidImageName', 'CreateContainerConfigError', 'ErrImageNeverPull')
+# ErrImagePull messages of images that do not exist or may not be pulled, as opposed to
+# e.g. registry timeouts
+HOPELESS_PULL_MESSAGES = ('not found', 'manifest unknown', 'pull access denied',
+                          'repository does not exist', 'unauthorized')
+# Waiting reasons of containers that are not there yet, which events may explain
+STARTING_REASONS = ('ContainerCreating', 'PodInitializing')
+# Warning events of pods that are stuck, rather than slow (e.g. pulling a large image)
+STUCK_EVENT_REASONS = ('FailedMount', 'FailedAttachVolume', 'FailedMapVolume')
+# Pending pods of a job are looked at no more often than this, in seconds
+POD_CHECK_INTERVAL = 30
+NEVER = datetime.min.replace(tzinfo=timezone.utc)
+
+
+def event_time(event):
+    return getattr(event, 'last_timestamp', None) or getattr(event, 'event_time', None) or \
+        getattr(event, 'first_timestamp', None) or NEVER
+
+
+def pod_failure(pod, pending_for, timeout, list_events=None):
+    '''
+    Returns why the pending 'pod' will never run, or None if it may still run.
+    Invalid images, missing configuration and images that do not exist fail
+    it at once; image pull back-offs, unschedulable pods (e.g. with an unbound
+    PVC) and volumes failing to attach or mount fail it once it has been
+    pending for 'timeout' seconds. 'list_events(pod)' returns the events of
+    the pod, of which only the ones since it started count.
+    '''
+    statuses = (pod.status.init_container_statuses or []) + \
+               (pod.status.container_statuses or [])
+    waiting = [status.state.waiting for status in statuses
+               if status.state and status.state.waiting]
+
+    for state in waiting:
+        message = state.message or ''
+        if state.reason in HOPELESS_WAITING_REASONS or \
+                (state.reason == 'ErrImagePull' and
+                 any(hint in message.lower() for hint in HOPELESS_PULL_MESSAGES)):
+            return '{}: {}'.format(state.reason, message)
+
+    if pending_for <= timeout:
+        return None
+
+    for state in waiting:
+        if state.reason in ('ImagePullBackOff', 'ErrImagePull'):
+            return '{}: {}'.format(state.reason, state.message)
+
+    for condition in pod.status.conditions or []:
+        if condition.type == 'PodScheduled' and condition.status == 'False' and \
+                condition.reason == 'Unschedulable':
+            return 'Unschedulable: {}'.format(condition.message)
+
+    if list_events is not None and all(state.reason in STARTING_REASONS for state in waiting):
+        started = pod.status.start_time or pod.metadata.creation_timestamp or NEVER
+        # The API does not order events
+        warnings = sorted((event for event in list_events(pod)
+                           if event.type == 'Warning' and event.reason in STUCK_EVENT_REASONS
+                           and event_time(event) >= started),
+                          key=event_time)
+        if warnings:
+            return '{}: {}'.format(warnings[-1].reason, warnings[-1].message)
+
+    return None
+
+
 class Job:
-    def __init__(self, body, name='task-job', namespace='default'):
+    def __init__(self, body, name='task-job', namespace='default', api_client=None):
         self.name = name
         self.namespace = namespace
         self.status = 'Initialized'
-        self.bv1 = client.BatchV1Api()
-        self.cv1 = client.CoreV1Api()
+        self.bv1 = client.BatchV1Api(api_client)
+        self.cv1 = client.CoreV1Api(api_client)
         self.timeout = 240
+        self.resource_version = None
+        self.watched_job = None
+        self.reason = None
+        self.pod_check_interval = POD_CHECK_INTERVAL
+        self.pods_checked_at = None
         self.body = body
         self.body['metadata']['name'] = self.name
 
-    def run_to_completion(self, poll_interval, check_cancelled, pod_timeout):
+    def run_to_completion(self, poll_interval, check_cancelled, pod_timeout, watch_timeout=None):
+        '''
+        Waits for the job to finish. By default the job is polled every 'poll_interval' seconds.
+        If 'watch_timeout' is given, the job is watched instead and the wait ends as soon as a
+        terminal condition shows up; each watch lasts at most 'watch_timeout' seconds, after
+        which cancellation and pod state are checked again.
+        '''
 
         logging.debug("Creating job '{}'...".format(self.name))
         logging.debug(pprint(self.body))
@@ -38,13 +116,51 @@ class Job:
             if check_cancelled():
                 self.delete()
                 return 'Cancelled'
-            time.sleep(poll_interval)
-            status, is_all_pods_running = self.get_status(is_all_pods_running)
+            if watch_timeout:
+                job = self.wait_for_update(watch_timeout, poll_interval)
+            else:
+                time.sleep(poll_interval)
+                job = None
+            status, is_all_pods_running = self.get_status(is_all_pods_running, job)
         return status
 
+    def wait_for_update(self, watch_timeout, poll_interval):
+        '''
+        Watches the job until it gets a condition or 'watch_timeout' seconds elapse and returns
+        the last seen version of it. The watch resumes from the last seen resourceVersion; if that
+        version expired (410 Gone), or the watch fails, this falls back to a single polling
+        interval and returns None, so the caller reads the job again.
+        '''
+        w = watch.Watch()
+        kwargs = {'field_selector': 'metadata.name={}'.format(self.name),
+                  'timeout_seconds': int(watch_timeout)}
+        # The client sends unset arguments as the string 'None', which the API server rejects
+        if self.resource_version is not None:
+            kwargs['resource_version'] = self.resource_version
+        try:
+            for event in w.stream(self.bv1.list_namespaced_job, self.namespace, **kwargs):
+                if event['type'] == 'ERROR':
+                    logging.debug("Watch on job '{}' failed: {}".format(self.name, event['raw_object']))
+                    self.resource_version = None
+                    w.stop()
+                    time.sleep(poll_interval)
+                    return None
+                job = event['object']
+                self.resource_version = job.metadata.resource_version
+                self.watched_job = job
+                if job.status and job.status.conditions:
+                    w.stop()
+                    break
+        except ApiException as ex:
+            logging.debug("Watch on job '{}' failed with status {}, polling".format(self.name, ex.status))
+            self.resource_version = None
+            time.sleep(poll_interval)
+            return None
+        return self.watched_job
 
-    def get_status(self, is_all_pods_runnning):
-        job = self.bv1.read_namespaced_job(self.name, self.namespace)
+    def get_status(self, is_all_pods_runnning, job=None):
+        if job is None:
+            job = self.bv1.read_namespaced_job(self.name, self.namespace)
         try:
             # Loops around the status conditions array, and looks for 'Complete', 'Failed' or
             #    'SuccessCriteriaMet'. If none of these are found, the Job is marked as 'Error'
@@ -61,24 +177,40 @@ class Job:
                 self.status = 'Error'
         except TypeError:  # The condition is not initialized, so it is not complete yet, wait for it
             self.status = 'Running'
-            job_duration = 0
-            if job.status.active and job.status.start_time:
-                job_duration = (datetime.now(timezone.utc) - job.status.start_time).total_seconds()
-            if job_duration > self.timeout and not is_all_pods_runnning:
+            # Pending pods are checked for states they will never leave, until all pods run
+            if job.status.active and not is_all_pods_runnning and self.pod_check_due():
                 pods = (self.cv1.list_namespaced_pod(self.namespace
                                                     , label_selector='job-name={}'.format(self.name))).items
                 is_all_pods_runnning = True
                 for pod in pods:
-                    if pod.status.phase == "Pending" and pod.status.start_time:
+                    if pod.status.phase == "Pending":
                         is_all_pods_runnning = False
-                        delta = (datetime.now(timezone.utc) - pod.status.start_time).total_seconds()
-                        if delta > self.timeout and \
-                                pod.status.container_statuses[0].state.waiting.reason == "ImagePullBackOff":
-                            logging.info(pod.status.container_statuses[0].state.waiting)
+                        started = pod.status.start_time or pod.metadata.creation_timestamp
+                        delta = (datetime.now(timezone.utc) - started).total_seconds()
+                        reason = pod_failure(pod, delta, self.timeout, self.list_pod_events)
+                        if reason is not None:
+                            self.reason = reason
+                            logging.error("Job '{}' cannot run: {}".format(self.name, reason))
                             return 'Error', is_all_pods_runnning
 
         return self.status, is_all_pods_runnning
 
+    def pod_check_due(self):
+        '''
+        Whether the pending pods are to be looked at on this poll: at most once
+        every 'pod_check_interval' seconds, to keep the load on the API server down.
+        '''
+        now = time.monotonic()
+        if self.pods_checked_at is not None and now - self.pods_checked_at < self.pod_check_interval:
+            return False
+        self.pods_checked_at = now
+        return True
+
+    def list_pod_events(self, pod):
+        return self.cv1.list_namespaced_event(
+            self.namespace,
+            field_selector='involvedObject.name={}'.format(pod.metadata.name)).items
+
     def delete(self):
         logging.info("Removing failed jobs")
         self.bv1.delete_namespaced_job(
@@ -0,0 +1,42 @@
+import socket
+from kubernetes import client
+from urllib3.connection import HTTPConnection
+from tesk_core.Util import env_int
+
+
+class TaskApiClient(client.ApiClient):
+    '''
+    ApiClient giving every request that sets no timeout of its own
+    'connect_timeout' seconds to connect. Reads are not limited, since
+    watches legitimately wait for a long time.
+    '''
+
+    def __init__(self, configuration=None, connect_timeout=None):
+        client.ApiClient.__init__(self, configuration)
+        self.connect_timeout = connect_timeout
+
+    def request(self, method, url, *args, _request_timeout=None, **kwargs):
+        if _request_timeout is None and self.connect_timeout is not None:
+            _request_timeout = (self.connect_timeout, None)
+        return client.ApiClient.request(self, method, url, *args,
+                                        _request_timeout=_request_timeout, **kwargs)
+
+
+def new_api_client():
+    '''
+    The ApiClient the taskmaster shares between all its Job and PVC objects,
+    so that a task talks to the API server over a few kept-alive connections
+    instead of connecting (and shaking hands over TLS) for every object.
+    Build it after loading the Kubernetes configuration.
+
+    KUBE_API_POOL_SIZE (default 4) connections are kept open, with TCP
+    keep-alive so idle ones are not silently dropped; KUBE_API_CONNECT_TIMEOUT
+    (seconds, default none) bounds connecting.
+    '''
+
+    configuration = client.Configuration()
+    configuration.connection_pool_maxsize = env_int('KUBE_API_POOL_SIZE', 4)
+    api_client = TaskApiClient(configuration, env_int('KUBE_API_CONNECT_TIMEOUT'))
+    api_client.rest_client.pool_manager.connection_pool_kw['socket_options'] = \
+        HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    return api_client
@@ -37,6 +37,14 @@ def fileEnabled():
        and CONTAINER_BASE_PATH  is not None
 
 
+def fileVolumeMounted():
+    '''
+    Is the transfer volume mounted here, i.e. can file:// inputs be looked at?
+    '''
+    
+    return CONTAINER_BASE_PATH is not None and os.path.isdir(CONTAINER_BASE_PATH)
+
+
 def getPath(url):
     
     parsed_url = urlparse(url)
@@ -68,6 +76,32 @@ def containerPath(path):
     relPath = relpath(path, HOST_BASE_PATH)
     
     return os.path.join(CONTAINER_BASE_PATH, relPath)
+
+
+def directInput(filedata):
+    '''
+    Is 'filedata' a file:// input that executors read straight from the
+    transfer volume, instead of the filer copying it?
+
+    Only with FILER_DIRECT_FILE_INPUTS set, and only for paths under
+    HOST_BASE_PATH.
+    '''
+    
+    if not getEnv('FILER_DIRECT_FILE_INPUTS') or not fileEnabled() \
+            or 'content' in filedata:
+        
+        return False
+    
+    return urlparse(filedata['url']).scheme in ('file', '') \
+       and isDescendant(HOST_BASE_PATH, getPath(filedata['url']))
+
+
+def transferSubPath(url):
+    '''
+    Path of the file:// 'url' relative to the root of the transfer volume
+    '''
+    
+    return relpath(containerPath(getPath(url)), CONTAINER_BASE_PATH)
     
     
 
@@ -0,0 +1,76 @@
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed, CancelledError
+
+# 'bytes' and 'files' only count the transfers of known size
+Plan = namedtuple('Plan', ['bytes', 'files', 'unknown', 'missing'])
+
+
+def plan_transfers(transfers, size_of, workers=8):
+    '''
+    Resolves the size of every entry of 'transfers' concurrently, with
+    'size_of(filedata)' returning (bytes, files) - bytes None if unknown - or
+    raising FileNotFoundError for inputs that do not exist. No data is
+    transferred.
+
+    Known sizes are attached to the entries as 'size', which the scheduler
+    uses to start the largest transfers first. Once an input is found
+    missing, the entries not resolved yet are skipped.
+    '''
+
+    total, files, unknown, missing = 0, 0, 0, []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(size_of, filedata): filedata for filedata in transfers}
+        for future in as_completed(futures):
+            filedata = futures[future]
+            try:
+                size, count = future.result()
+            except CancelledError:
+                continue
+            except FileNotFoundError as err:
+                logging.error('Input %s does not exist: %s',
+                              filedata.get('url', filedata['path']), err)
+                missing.append(filedata)
+                for pending in futures:
+                    pending.cancel()
+                continue
+            except Exception as err:
+                logging.warning('Unable to size %s: %r', filedata.get('url'), err)
+                unknown += 1
+                continue
+
+            if size is None:
+                unknown += 1
+                continue
+            filedata['size'] = size
+            total += size
+            files += count
+
+    logging.info('Planned %d transfers: %d bytes in %d files, %d of unknown size, %d missing',
+                 len(transfers), total, files, unknown, len(missing))
+    return Plan(total, files, unknown, missing)
+
+
+def check_destinations(transfers, check, workers=8):
+    '''
+    Runs 'check(filedata)' for every entry of 'transfers' concurrently and
+    returns the entries it failed for, by returning non-zero or raising.
+    '''
+
+    failed = []
+
+    def run(filedata):
+        try:
+            return check(filedata)
+        except Exception as err:
+            logging.error('Unable to check %s: %r', filedata.get('url'), err)
+            return 1
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for filedata, result in zip(transfers, executor.map(run, transfers)):
+            if result:
+                logging.error('Output destination %s failed its pre-flight check',
+                              filedata.get('url'))
+                failed.append(filedata)
+    return failed
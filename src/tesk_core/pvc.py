@@ -7,7 +7,7 @@ import logging
 
 class PVC():
 
-    def __init__(self, name='task-pvc', size_gb=1, namespace='default'):
+    def __init__(self, name='task-pvc', size_gb=1, namespace='default', api_client=None):
         self.name = name
         self.spec = {'apiVersion': 'v1',
                      'kind': 'PersistentVolumeClaim',
@@ -20,7 +20,7 @@ class PVC():
 
         self.subpath_idx = 0
         self.namespace = namespace
-        self.cv1 = client.CoreV1Api()
+        self.cv1 = client.CoreV1Api(api_client)
 
         # The environment variable 'TESK_API_TASKMASTER_ENVIRONMENT_STORAGE_CLASS_NAME'
         # can be set to the preferred, non-default, user-defined storageClass
@@ -51,6 +51,5 @@ class PVC():
 
 
     def delete(self):
-        cv1 = client.CoreV1Api()
-        cv1.delete_namespaced_persistent_volume_claim(
+        self.cv1.delete_namespaced_persistent_volume_claim(
             self.name, self.namespace, body=client.V1DeleteOptions())
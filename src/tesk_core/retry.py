@@ -0,0 +1,119 @@
+import ftplib
+import logging
+import random
+import threading
+import time
+import botocore.exceptions
+import requests
+import urllib3.exceptions
+from tesk_core.Util import env_int
+
+# Responses that say "not now" rather than "never"
+TRANSIENT_HTTP_STATUS = frozenset((408, 429, 500, 502, 503, 504))
+TRANSIENT_S3_CODES = frozenset((
+    'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+    'RequestTimeout', 'InternalError', 'ServiceUnavailable',
+    '500', '502', '503', '504'))
+
+_budget_lock = threading.Lock()
+_budget = None
+
+
+def is_transient(err):
+    '''
+    Whether the exception 'err' is worth retrying: dropped connections,
+    timeouts, 5xx / throttling responses and FTP 4xx replies.
+    '''
+
+    if isinstance(err, botocore.exceptions.ClientError):
+        return err.response.get('Error', {}).get('Code') in TRANSIENT_S3_CODES or \
+            err.response.get('ResponseMetadata', {}).get('HTTPStatusCode') \
+            in TRANSIENT_HTTP_STATUS
+    if isinstance(err, requests.HTTPError):
+        return err.response is not None and \
+            err.response.status_code in TRANSIENT_HTTP_STATUS
+    # A connection dropped mid-body surfaces as ChunkedEncodingError or ProtocolError
+    return isinstance(err, (
+        requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+        urllib3.exceptions.ProtocolError,
+        botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError,
+        ftplib.error_temp, EOFError, ConnectionError, TimeoutError))
+
+
+class RetryBudget:
+    '''
+    Retries left for the whole filer run. It is shared by all transfers, so
+    an endpoint that is down for good costs a bounded amount of time rather
+    than a few retries per file.
+    '''
+
+    def __init__(self, retries):
+        self.lock = threading.Lock()
+        self.left = retries
+
+    def take(self):
+        with self.lock:
+            if self.left <= 0:
+                return False
+            self.left -= 1
+            return True
+
+
+def retry_budget():
+    '''
+    The budget of this run, FILER_RETRY_BUDGET retries (default 20).
+    '''
+
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = RetryBudget(env_int('FILER_RETRY_BUDGET', 20))
+        return _budget
+
+
+def backoff_delay(attempt, base, cap):
+    '''
+    Exponential backoff with full jitter, so transfers failing together do
+    not retry together.
+    '''
+
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retrying(operation, description, sleep=time.sleep):
+    '''
+    Runs 'operation', which returns (result, transient): the filer's 0/1
+    result and whether a failure is worth retrying. Transient failures,
+    including transient exceptions, are retried up to FILER_RETRIES times
+    (default 3) while the retry budget lasts, waiting from
+    FILER_RETRY_BASE_DELAY_MS (default 1000) up to FILER_RETRY_MAX_DELAY_MS
+    (default 30000) in between. Any other exception is raised.
+    '''
+
+    retries = env_int('FILER_RETRIES', 3)
+    base = env_int('FILER_RETRY_BASE_DELAY_MS', 1000) / 1000
+    cap = env_int('FILER_RETRY_MAX_DELAY_MS', 30000) / 1000
+
+    attempt = 0
+    while True:
+        try:
+            result, transient = operation()
+            error = None
+        except Exception as err:
+            if not is_transient(err):
+                raise
+            logging.error('Transfer of %s failed: %r', description, err)
+            result, transient, error = 1, True, err
+
+        if not result or not transient:
+            return result
+        if attempt >= retries or not retry_budget().take():
+            logging.error('Giving up on %s after %d attempts', description, attempt + 1)
+            return 1
+
+        delay = backoff_delay(attempt, base, cap)
+        attempt += 1
+        logging.warning('Retrying %s in %.1fs (attempt %d of %d)%s', description,
+                        delay, attempt + 1, retries + 1,
+                        ': {!r}'.format(error) if error else '')
+        sleep(delay)
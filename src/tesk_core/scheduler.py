@@ -0,0 +1,101 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from tesk_core.transput import urlparse
+
+
+def host_of(filedata):
+    '''
+    Returns the (scheme, netloc) the transfer of 'filedata' talks to, or None
+    for entries that need no remote host (e.g. literal 'content').
+    '''
+
+    if 'content' in filedata:
+        return None
+    parsed_url = urlparse(filedata['url'])
+    return parsed_url.scheme or 'file', parsed_url.netloc
+
+
+def local_size(path):
+    '''
+    Size in bytes of a local file or directory tree, 0 if it does not exist.
+    '''
+
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+def transfer_size(ttype, filedata):
+    '''
+    Best known size of a transfer, used to start the largest ones first.
+    Outputs are measured on disk; inputs use the 'size' a planner may have
+    attached to the entry, and count as 0 otherwise.
+    '''
+
+    if 'content' in filedata:
+        return len(str(filedata['content']))
+    if ttype == 'outputs':
+        return local_size(filedata['path'])
+    return filedata.get('size', 0)
+
+
+def run_transfers(ttype, transfers, process, workers=1, per_host=None):
+    '''
+    Runs 'process(ttype, filedata)' for every entry of 'transfers' on a pool of
+    'workers' threads, with at most 'per_host' of them talking to the same
+    host at once. Transfers are started largest first, to finish the whole set
+    as early as possible.
+
+    On the first failing transfer no further transfers are started; the ones
+    already running are waited for, and 1 is returned. Returns 0 otherwise.
+    '''
+
+    pending = sorted(transfers, key=lambda filedata: transfer_size(ttype, filedata),
+                     reverse=True)
+    per_host = per_host or workers
+    running = {}
+    active = {}
+    failed = False
+
+    def run(filedata):
+        logging.debug('Processing file: %s', filedata['path'])
+        result = process(ttype, filedata)
+        if not result:
+            logging.debug('Processed file: %s', filedata['path'])
+        return result
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            if not failed:
+                for filedata in list(pending):
+                    if len(running) >= workers:
+                        break
+                    host = host_of(filedata)
+                    if host is not None and active.get(host, 0) >= per_host:
+                        continue
+                    pending.remove(filedata)
+                    active[host] = active.get(host, 0) + 1
+                    running[executor.submit(run, filedata)] = (filedata, host)
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                filedata, host = running.pop(future)
+                active[host] -= 1
+                if future.result():
+                    logging.error('Unable to process file %s', filedata['path'])
+                    if pending:
+                        logging.error('Cancelling %d pending transfers', len(pending))
+                    failed = True
+                    pending = []
+
+    return 1 if failed else 0
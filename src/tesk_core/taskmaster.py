@@ -1,22 +1,33 @@
 #!/usr/bin/env python3
 
 import argparse
+import copy
 import json
 import os
 import re
 import sys
 import logging
 import gzip
+import math
 from kubernetes import client, config
 from tesk_core.job import Job
 from tesk_core.pvc import PVC
 from tesk_core.filer_class import Filer
+from tesk_core import path
+from tesk_core.Util import env_int
+from tesk_core.kube_client import new_api_client
+from tesk_core.planner import plan_transfers
+from tesk_core.filer import input_size, ftp_pool
+from tesk_core.transput import urlparse
 
 created_jobs = []
 poll_interval = 5
 task_volume_basename = 'task-volume'
+transfer_volume_name = 'transfer-volume'
 args = None
 logger = None
+# Shared by all Job and PVC objects of the task, see new_api_client
+api_client = None
 
 def run_executor(executor, namespace, pvc=None):
     jobname = executor['metadata']['name']
@@ -25,17 +36,8 @@ def run_executor(executor, namespace, pvc=None):
     if os.environ.get('EXECUTOR_BACKOFF_LIMIT') is not None:
         executor['spec'].update({'backoffLimit': int(os.environ['EXECUTOR_BACKOFF_LIMIT'])})
 
-    if 'restartPolicy'  not in spec.keys() and \
-       'restart_policy' in spec.keys():
-        spec['restartPolicy'] = spec['restart_policy']
-
-    for container in spec['containers']:
-        if 'limits' not in container['resources'].keys():
-            container['resources']['limits'] = None
-        if container['resources']['limits'] is None and \
-          ('requests' in container['resources'].keys() and \
-           container['resources']['requests'] is not None):
-            container['resources']['limits'] = container['resources']['requests']
+    set_restart_policy(spec)
+    set_resource_limits(spec['containers'])
 
     if pvc is not None:
         mounts = spec['containers'][0].setdefault('volumeMounts', [])
@@ -47,19 +49,37 @@ def run_executor(executor, namespace, pvc=None):
             # This makes sure the next line does not fail if volumes was originaly "null"
         spec['volumes'].extend([{'name': task_volume_basename, 'persistentVolumeClaim': {
             'readonly': False, 'claimName': pvc.name}}])
+        if any(mount['name'] == transfer_volume_name for mount in pvc.volume_mounts):
+            spec['volumes'].append({'name': transfer_volume_name, 'persistentVolumeClaim': {
+                'readOnly': True, 'claimName': path.TRANSFER_PVC_NAME}})
     logger.debug('Created job: ' + jobname)
-    job = Job(executor, jobname, namespace)
+    job = Job(executor, jobname, namespace, api_client)
     logger.debug('Job spec: ' + str(job.body))
 
     global created_jobs
     created_jobs.append(job)
 
-    status = job.run_to_completion(poll_interval, check_cancelled,args.pod_timeout)
+    status = job.run_to_completion(poll_interval, check_cancelled, args.pod_timeout,
+                                   env_int('JOB_WATCH_TIMEOUT'))
     if status != 'Complete':
         if status == 'Error':
             job.delete()
         exit_cancelled('Got status ' + status)
 
+def set_restart_policy(spec):
+    if 'restartPolicy'  not in spec.keys() and \
+       'restart_policy' in spec.keys():
+        spec['restartPolicy'] = spec['restart_policy']
+
+def set_resource_limits(containers):
+    for container in containers:
+        if 'limits' not in container['resources'].keys():
+            container['resources']['limits'] = None
+        if container['resources']['limits'] is None and \
+          ('requests' in container['resources'].keys() and \
+           container['resources']['requests'] is not None):
+            container['resources']['limits'] = container['resources']['requests']
+
 # TODO move this code to PVC class
 
 
@@ -103,7 +123,11 @@ def generate_mounts(data, pvc):
 
     # gather other paths that need to be mounted from inputs/outputs FILE and
     # DIRECTORY entries
+    direct_inputs = []
     for aninput in data['inputs']:
+        if path.directInput(aninput):
+            direct_inputs.append(aninput)
+            continue
         dirnm = dirname(aninput)
         append_mount(volume_mounts, volume_name, dirnm, pvc)
 
@@ -111,6 +135,15 @@ def generate_mounts(data, pvc):
         dirnm = dirname(anoutput)
         append_mount(volume_mounts, volume_name, dirnm, pvc)
 
+    # file:// inputs the filer does not copy are mounted read-only from the
+    # transfer volume, on top of the task volume mounts
+    for aninput in direct_inputs:
+        logger.debug('mounting ' + aninput['url'] + ' at ' + aninput['path'])
+        volume_mounts.append({'name': transfer_volume_name,
+                              'mountPath': aninput['path'],
+                              'subPath': path.transferSubPath(aninput['url']),
+                              'readOnly': True})
+
     return volume_mounts
 
 
@@ -118,13 +151,15 @@ def init_pvc(data, filer):
     task_name = data['executors'][0]['metadata']['labels']['taskmaster-name']
     pvc_name = task_name + '-pvc'
     pvc_size = data['resources']['disk_gb']
-    pvc = PVC(pvc_name, pvc_size, args.namespace)
+    pvc = PVC(pvc_name, pvc_size, args.namespace, api_client)
 
     mounts = generate_mounts(data, pvc)
     logging.debug(mounts)
     logging.debug(type(mounts))
     pvc.set_volume_mounts(mounts)
     filer.add_volume_mount(pvc)
+    if os.environ.get('FILER_RESUME'):
+        filer.add_checkpoint_mount()
 
     pvc.create()
     # to global var for cleanup purposes
@@ -137,18 +172,148 @@ def init_pvc(data, filer):
     filerjob = Job(
         filer.get_spec('inputs', args.debug),
         task_name + '-inputs-filer',
-        args.namespace)
+        args.namespace,
+        api_client)
 
     global created_jobs
     created_jobs.append(filerjob)
     # filerjob.run_to_completion(poll_interval)
-    status = filerjob.run_to_completion(poll_interval, check_cancelled, args.pod_timeout)
+    status = filerjob.run_to_completion(poll_interval, check_cancelled, args.pod_timeout,
+                                        env_int('JOB_WATCH_TIMEOUT'))
     if status != 'Complete':
         exit_cancelled('Got status ' + status)
 
     return pvc
 
 
+def plan_inputs(data):
+    '''
+    Sizes the inputs before any Kubernetes object is created, and gives up
+    on the task if one of them does not exist. With PVC_SIZE_HEADROOM set
+    (in percent), 'disk_gb' is raised to fit the inputs plus that headroom.
+
+    Inputs the taskmaster cannot look at (e.g. file:// ones, or without the
+    filer's credentials) are of unknown size and left to the filer.
+    '''
+    try:
+        plan = plan_transfers(data['inputs'], plan_input_size, workers=env_int('PLAN_WORKERS', 8))
+    finally:
+        ftp_pool.close_all()
+    if plan.missing:
+        exit_cancelled('Missing inputs: ' +
+                       ', '.join(filedata['url'] for filedata in plan.missing))
+
+    headroom = env_int('PVC_SIZE_HEADROOM')
+    if headroom is not None:
+        needed_gb = math.ceil(plan.bytes * (100 + headroom) / 100 / 1024 ** 3)
+        if needed_gb > (data['resources'].get('disk_gb') or 0):
+            logger.debug('Raising disk_gb to ' + str(needed_gb) + ' for ' +
+                         str(plan.bytes) + ' bytes of inputs')
+            data['resources']['disk_gb'] = needed_gb
+
+
+def plan_input_size(filedata):
+    '''
+    input_size of 'filedata' as probed from the taskmaster. Only HTTP and FTP
+    inputs without a netrc secret are probed with the credentials the filer
+    will use: the filer reads the netrc secret, and its S3 credentials, from
+    mounts the taskmaster does not have.
+    '''
+    scheme = urlparse(filedata.get('url', '')).scheme
+    same_credentials = scheme in ('http', 'https', 'ftp') and \
+        os.environ.get('NETRC_SECRET_NAME') is None
+    return input_size(filedata, same_credentials)
+
+
+def run_single_pod_task(data, filer):
+    '''
+    Runs the inputs filer, the executors and the outputs filer as the containers of
+    a single pod, so the task is scheduled only once: the inputs filer and the
+    executors are init containers (which Kubernetes runs one after the other) and
+    the outputs filer is the main container.
+
+    The task volume is an emptyDir limited to the task's disk_gb, or the task PVC
+    if SINGLE_POD_TASK is 'pvc'. The pod restarts as the first executor asks to, and
+    the job is retried up to the smaller of the filer and executor backoff limits.
+
+    There are no per-executor jobs in this mode, so clients that look executors up
+    by their job (like the TESK API, for status and logs) only see the task job,
+    labelled job-type 'task'. Its 'executor-containers' annotation lists the
+    containers of the executors, in order, to read their logs from.
+    '''
+    task_name = data['executors'][0]['metadata']['labels']['taskmaster-name']
+    use_pvc = os.environ.get('SINGLE_POD_TASK') == 'pvc'
+    pvc = PVC(task_name + '-pvc', data['resources']['disk_gb'], args.namespace, api_client)
+
+    mounts = generate_mounts(data, pvc)
+    pvc.set_volume_mounts(mounts)
+
+    if os.environ.get('NETRC_SECRET_NAME') is not None:
+        filer.add_netrc_mount(os.environ.get('NETRC_SECRET_NAME'))
+
+    body = copy.deepcopy(filer.get_spec('inputs', args.debug))
+    labels = dict(data['executors'][0]['metadata'].get('labels') or {})
+    labels.pop('executor-no', None)
+    labels['job-type'] = 'task'
+    body['metadata']['labels'] = labels
+    spec = body['spec']['template']['spec']
+
+    inputs_filer = spec['containers'][0]
+    inputs_filer['name'] = 'inputs-filer'
+    inputs_filer['volumeMounts'].extend(mounts)
+    outputs_filer = copy.deepcopy(inputs_filer)
+    outputs_filer['name'] = 'outputs-filer'
+    outputs_filer['args'][0] = 'outputs'
+
+    init_containers = [inputs_filer]
+    for executor in data['executors']:
+        executor_spec = executor['spec']['template']['spec']
+        set_restart_policy(executor_spec)
+        set_resource_limits(executor_spec['containers'])
+        executor_spec['containers'][0].setdefault('volumeMounts', []).extend(mounts)
+        init_containers.extend(executor_spec['containers'])
+        spec['volumes'].extend(executor_spec.get('volumes') or [])
+
+    spec['initContainers'] = init_containers
+    spec['containers'] = [outputs_filer]
+    spec['restartPolicy'] = data['executors'][0]['spec']['template']['spec'].get(
+        'restartPolicy', spec['restartPolicy'])
+    body['metadata'].setdefault('annotations', {})['executor-containers'] = ','.join(
+        container['name'] for container in init_containers[1:])
+    # A retry reruns the whole task, so it is retried no more than either its
+    # filers or its executors would be
+    limits = [limit for limit in (body['spec'].get('backoffLimit'),
+                                  env_int('EXECUTOR_BACKOFF_LIMIT')) if limit is not None]
+    if limits:
+        body['spec']['backoffLimit'] = min(limits)
+
+    if use_pvc:
+        pvc.create()
+        global created_pvc
+        created_pvc = pvc
+        spec['volumes'].append({'name': task_volume_basename,
+                                'persistentVolumeClaim': {'claimName': pvc.name}})
+    else:
+        empty_dir = {}
+        if data['resources'].get('disk_gb'):
+            empty_dir['sizeLimit'] = str(data['resources']['disk_gb']) + 'Gi'
+        spec['volumes'].append({'name': task_volume_basename, 'emptyDir': empty_dir})
+
+    job = Job(body, task_name + '-task', args.namespace, api_client)
+
+    global created_jobs
+    created_jobs.append(job)
+
+    status = job.run_to_completion(poll_interval, check_cancelled, args.pod_timeout,
+                                   env_int('JOB_WATCH_TIMEOUT'))
+    if status != 'Complete':
+        if status == 'Error':
+            job.delete()
+        exit_cancelled('Got status ' + status)
+    elif use_pvc:
+        pvc.delete()
+
+
 def run_task(data, filer_name, filer_version, have_json_pvc=False):
     task_name = data['executors'][0]['metadata']['labels']['taskmaster-name']
     pvc = None
@@ -158,6 +323,9 @@ def run_task(data, filer_name, filer_version, have_json_pvc=False):
     else:
         json_pvc = None
 
+    if data['inputs'] and os.environ.get('PLAN_INPUTS') is not None:
+        plan_inputs(data)
+
     if data['volumes'] or data['inputs'] or data['outputs']:
 
         filer = Filer(task_name + '-filer', data, filer_name, filer_version, args.pull_policy_always, json_pvc)
@@ -170,6 +338,10 @@ def run_task(data, filer_name, filer_version, have_json_pvc=False):
         if os.environ.get('FILER_BACKOFF_LIMIT') is not None:
             filer.set_backoffLimit(int(os.environ['FILER_BACKOFF_LIMIT']))
 
+        if os.environ.get('SINGLE_POD_TASK') is not None:
+            run_single_pod_task(data, filer)
+            return
+
         pvc = init_pvc(data, filer)
 
     for executor in data['executors']:
@@ -183,13 +355,15 @@ def run_task(data, filer_name, filer_version, have_json_pvc=False):
         filerjob = Job(
             filer.get_spec('outputs', args.debug),
             task_name + '-outputs-filer',
-            args.namespace)
+            args.namespace,
+            api_client)
 
         global created_jobs
         created_jobs.append(filerjob)
 
         # filerjob.run_to_completion(poll_interval)
-        status = filerjob.run_to_completion(poll_interval, check_cancelled, args.pod_timeout)
+        status = filerjob.run_to_completion(poll_interval, check_cancelled, args.pod_timeout,
+                                        env_int('JOB_WATCH_TIMEOUT'))
         if status != 'Complete':
             exit_cancelled('Got status ' + status)
         else:
@@ -308,6 +482,9 @@ def main():
     else:
         config.load_incluster_config()
 
+    global api_client
+    api_client = new_api_client()
+
     global created_pvc
     created_pvc = None
 
@@ -2,6 +2,7 @@ import enum
 import os
 import netrc
 import logging
+from tesk_core.Util import env_int
 try:
     from urllib.parse import urlparse
 except ImportError:
@@ -15,6 +16,9 @@ class Type(enum.Enum):
 
 
 class Transput:
+    # Set on a failure worth retrying, e.g. a 503 (see tesk_core.retry)
+    transient = False
+
     def __init__(self, path, url, ftype):
         self.path = path
         self.url = url
@@ -42,6 +46,10 @@ class Transput:
         logging.debug('%s uploading %s %s', self.__class__.__name__,
                       self.ftype, self.url)
         if self.ftype == Type.File:
+            # With FILER_SYNC_OUTPUTS set, files already at the destination are skipped
+            if env_int('FILER_SYNC_OUTPUTS', 0) and self.destination_unchanged():
+                logging.info('Skipping unchanged %s, already at %s', self.path, self.url)
+                return 0
             return self.upload_file()
         if self.ftype == Type.Directory:
             return self.upload_dir()
@@ -59,6 +67,38 @@ class Transput:
     def delete(self):
         pass
 
+    def destination_unchanged(self):
+        '''
+        Whether the file at 'url' is known to match the local file, so
+        uploading it again can be skipped. Only a safe guess is allowed:
+        when in doubt, return False.
+        '''
+        return False
+
+    def input_size(self):
+        '''
+        (bytes, files) of the input at 'url', for planning the transfers
+        (see tesk_core.planner), with bytes None where unknown. Raises
+        FileNotFoundError if the input certainly does not exist.
+        '''
+        return None, None
+
+    def output_check(self):
+        '''
+        Checks, before the executors run, that the output can be uploaded to
+        'url' later. Returns 1 (and logs why) if it certainly cannot, 0
+        otherwise.
+        '''
+        return 0
+
+    def cache_validator(self):
+        '''
+        A string that changes whenever the file at 'url' changes (an ETag,
+        a modification time, ...), for the input cache to tell whether its
+        copy is current. None if there is no such thing.
+        '''
+        return None
+
     def download_file(self):
         raise NotImplementedError()
 
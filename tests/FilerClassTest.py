@@ -136,6 +136,33 @@ class FilerClassTest_no_env(unittest.TestCase):
         ])
 
 
+    @patch.dict(os.environ, {'FILER_HTTP_CHUNK_SIZE': '65536'})
+    def test_tuning_env(self):
+
+        f = Filer('name', {'a': 1})
+        self.assertIn({'name': 'FILER_HTTP_CHUNK_SIZE', 'value': '65536'}, f.getEnv())
+
+
+    def test_checkpoint_mount(self):
+
+        f = Filer('name', {'a': 1})
+        f.add_checkpoint_mount()
+        self.assertIn({'name': 'task-volume', 'mountPath': '/checkpoint',
+                       'subPath': 'filer-checkpoint'}, f.getVolumeMounts())
+        self.assertIn({'name': 'FILER_CHECKPOINT_DIR', 'value': '/checkpoint'}, f.getEnv())
+
+
+    def test_cache_mount(self):
+
+        with patch.dict('os.environ', {'FILER_CACHE_HOST_PATH': '/var/cache/tesk'}):
+            f = Filer('name', {'a': 1})
+        self.assertIn({'name': 'input-cache', 'mountPath': '/cache'}, f.getVolumeMounts())
+        self.assertIn({'name': 'input-cache',
+                       'hostPath': {'path': '/var/cache/tesk', 'type': 'DirectoryOrCreate'}},
+                      f.getVolumes())
+        self.assertIn({'name': 'FILER_CACHE_DIR', 'value': '/cache'}, f.getEnv())
+
+
     def test_image_pull_policy(self):
 
         f = Filer('name', {'a': 1})
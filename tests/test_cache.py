@@ -0,0 +1,98 @@
+"""Tests for the filer's input cache using 'pytest'."""
+
+import os
+from unittest import mock
+
+from tesk_core.cache import InputCache, cache_key
+
+
+class FakeTransfer:
+    """ A download of 'content', with 'validator' as its cache validator."""
+
+    def __init__(self, path, content, validator='"etag"', result=0):
+        self.path = path
+        self.url = 'http://foo/reference.fa'
+        self.content = content
+        self.validator = validator
+        self.result = result
+        self.downloads = 0
+
+    def cache_validator(self):
+        return self.validator
+
+    def download_file(self):
+        self.downloads += 1
+        with open(self.path, 'wb') as fh:
+            fh.write(self.content)
+        return self.result
+
+
+def test_fetch_miss_then_hit(tmp_path):
+    """ Ensure a file is downloaded once and then served from the cache."""
+
+    cache = InputCache(str(tmp_path / 'cache'), 1024)
+    first = FakeTransfer(str(tmp_path / 'task1' / 'ref.fa'), b'ACGT')
+    second = FakeTransfer(str(tmp_path / 'task2' / 'ref.fa'), b'ACGT')
+
+    assert cache.fetch(first) == 0
+    assert cache.fetch(second) == 0
+    assert (first.downloads, second.downloads) == (1, 0)
+    assert (tmp_path / 'task2' / 'ref.fa').read_bytes() == b'ACGT'
+    assert first.path == str(tmp_path / 'task1' / 'ref.fa')
+
+
+def test_fetch_changed_remote(tmp_path):
+    """ Ensure a new validator means a new download."""
+
+    cache = InputCache(str(tmp_path / 'cache'), 1024)
+    cache.fetch(FakeTransfer(str(tmp_path / 'a'), b'old', validator='"v1"'))
+    changed = FakeTransfer(str(tmp_path / 'b'), b'new', validator='"v2"')
+
+    assert cache.fetch(changed) == 0
+    assert changed.downloads == 1
+    assert (tmp_path / 'b').read_bytes() == b'new'
+
+
+def test_fetch_uncacheable_or_failed(tmp_path):
+    """ Ensure files without a validator bypass the cache, and failed
+    downloads leave nothing in it."""
+
+    cache = InputCache(str(tmp_path / 'cache'), 1024)
+    assert cache.fetch(FakeTransfer(str(tmp_path / 'a'), b'x', validator=None)) == 0
+    assert cache.fetch(FakeTransfer(str(tmp_path / 'b'), b'x', result=1)) == 1
+    assert os.listdir(str(tmp_path / 'cache' / 'objects')) == []
+    assert os.listdir(str(tmp_path / 'cache' / 'tmp')) == []
+    assert os.listdir(str(tmp_path / 'cache' / 'locks')) == []
+
+
+def test_evict_least_recently_used(tmp_path):
+    """ Ensure the least recently used files go once the budget is exceeded."""
+
+    cache = InputCache(str(tmp_path / 'cache'), 10)
+    for i, name in enumerate(['old', 'recent']):
+        path = cache.object_path(cache_key(name, 'v'))
+        with open(path, 'wb') as fh:
+            fh.write(b'x' * 6)
+        os.utime(path, (i, i))
+
+    cache.evict()
+    assert not os.path.exists(cache.object_path(cache_key('old', 'v')))
+    assert os.path.exists(cache.object_path(cache_key('recent', 'v')))
+    assert not os.path.exists(cache.lock_path(cache_key('old', 'v')))
+    assert cache.used == 6
+
+
+def test_evict_only_over_budget(tmp_path):
+    """ Ensure the cache is only scanned for eviction when a fill may have
+    pushed it over its budget, and never on a hit."""
+
+    cache = InputCache(str(tmp_path / 'cache'), 10)
+    with mock.patch.object(InputCache, 'evict', autospec=True,
+                           side_effect=InputCache.evict) as mock_evict:
+        cache.fetch(FakeTransfer(str(tmp_path / 'a'), b'x' * 4, validator='"a"'))
+        cache.fetch(FakeTransfer(str(tmp_path / 'b'), b'x' * 4, validator='"b"'))
+        cache.fetch(FakeTransfer(str(tmp_path / 'c'), b'x' * 4, validator='"b"'))
+        assert mock_evict.call_count == 1
+        cache.fetch(FakeTransfer(str(tmp_path / 'd'), b'x' * 4, validator='"d"'))
+        assert mock_evict.call_count == 2
+    assert len(os.listdir(str(tmp_path / 'cache' / 'objects'))) == 2
@@ -0,0 +1,73 @@
+"""Tests for the filer's checkpoint manifest using 'pytest'."""
+
+import os
+from tesk_core.checkpoint import Manifest, partial_offset, start_partial, resume_offset, \
+    finish_partial
+
+
+def entry(name):
+    return {'path': '/data/' + name, 'url': 'http://foo/' + name, 'type': 'FILE'}
+
+
+def test_manifest_skips_completed(tmp_path):
+    """ Ensure a restarted run skips what an earlier run recorded, and only
+    records successful transfers."""
+
+    path = str(tmp_path / 'inputs.manifest')
+    processed = []
+
+    def process(ttype, filedata):
+        processed.append(filedata['path'])
+        return 1 if filedata['path'] == '/data/bad' else 0
+
+    first = Manifest(path).wrap(process)
+    assert first('inputs', entry('a')) == 0
+    assert first('inputs', entry('bad')) == 1
+
+    with open(path, 'a') as fh:
+        fh.write('{"url": "http://foo/tr')   # killed mid-write
+
+    second = Manifest(path).wrap(process)
+    assert second('inputs', entry('a')) == 0
+    assert second('inputs', entry('bad')) == 1
+    assert processed == ['/data/a', '/data/bad', '/data/bad']
+
+
+def test_partial_offset(tmp_path):
+    """ Ensure the offset to resume from is the size of the partial file."""
+
+    path = str(tmp_path / 'file')
+    assert partial_offset(path) == 0
+    with open(path + '.part', 'wb') as fh:
+        fh.write(b'0123')
+    assert partial_offset(path) == 4
+
+
+def test_resume_offset_same_version(tmp_path):
+    """ Ensure a partial file is only resumed from the version it was started
+    from, and discarded otherwise."""
+
+    path = str(tmp_path / 'file')
+    start_partial(path, '"v1"')
+    with open(path + '.part', 'wb') as fh:
+        fh.write(b'0123')
+    assert resume_offset(path, '"v1"') == 4
+    assert resume_offset(path, '"v2"') == 0
+    assert not os.path.exists(path + '.part')
+
+    start_partial(path, None)
+    with open(path + '.part', 'wb') as fh:
+        fh.write(b'0123')
+    assert resume_offset(path, None) == 0
+
+
+def test_finish_partial(tmp_path):
+    """ Ensure a finished download leaves neither its partial file nor its
+    validator behind."""
+
+    path = str(tmp_path / 'file')
+    start_partial(path, '"v1"')
+    with open(path + '.part', 'wb') as fh:
+        fh.write(b'0123')
+    finish_partial(path)
+    assert sorted(os.listdir(str(tmp_path))) == ['file']
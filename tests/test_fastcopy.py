@@ -0,0 +1,89 @@
+"""Tests for the filer's local copy engine using 'pytest'."""
+
+import errno
+import os
+
+from tesk_core.fastcopy import copy_file, copy_tree
+
+
+def test_copy_file(tmp_path):
+    """ Ensure contents and modification time are copied, into a directory
+    as with 'shutil.copy'."""
+
+    src = tmp_path / 'src.txt'
+    src.write_bytes(b'ACGT' * 1000)
+    os.utime(str(src), (1000, 1000))
+    (tmp_path / 'dst').mkdir()
+
+    dst = copy_file(str(src), str(tmp_path / 'dst'))
+
+    assert dst == str(tmp_path / 'dst' / 'src.txt')
+    assert (tmp_path / 'dst' / 'src.txt').read_bytes() == b'ACGT' * 1000
+    assert os.path.getmtime(dst) == 1000
+
+
+def test_copy_file_fallback(tmp_path, monkeypatch):
+    """ Ensure copies fall back to sendfile where copy_file_range is not
+    supported."""
+
+    def unsupported(*args):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+    monkeypatch.setattr(os, 'copy_file_range', unsupported)
+    src = tmp_path / 'src.txt'
+    src.write_bytes(b'x' * 100)
+
+    copy_file(str(src), str(tmp_path / 'dst.txt'))
+    assert (tmp_path / 'dst.txt').read_bytes() == b'x' * 100
+
+
+def test_copy_file_short(tmp_path, monkeypatch):
+    """ Ensure a kernel copy stopping short is completed by the next method
+    rather than leaving a truncated file."""
+
+    def short_copy(src, dst, count, offset_src, offset_dst):
+        return 0 if offset_src else os.pwrite(dst, b'x' * 30, 0)
+
+    monkeypatch.setattr(os, 'copy_file_range', short_copy)
+    monkeypatch.setattr(os, 'sendfile', lambda *args: 0)
+    src = tmp_path / 'src.txt'
+    src.write_bytes(b'x' * 30 + b'y' * 70)
+
+    copy_file(str(src), str(tmp_path / 'dst.txt'))
+    assert (tmp_path / 'dst.txt').read_bytes() == b'x' * 30 + b'y' * 70
+
+
+def test_copy_file_skip_unchanged(tmp_path, monkeypatch):
+    """ Ensure files matching in size and modification time are skipped."""
+
+    src = tmp_path / 'src.txt'
+    src.write_bytes(b'new!')
+    dst = tmp_path / 'dst.txt'
+    dst.write_bytes(b'old!')
+    for path in (src, dst):
+        os.utime(str(path), (1000, 1000))
+
+    monkeypatch.setenv('FILER_COPY_SKIP_UNCHANGED', '1')
+    copy_file(str(src), str(dst))
+    assert dst.read_bytes() == b'old!'
+
+    os.utime(str(src), (2000, 2000))
+    copy_file(str(src), str(dst))
+    assert dst.read_bytes() == b'new!'
+
+
+def test_copy_tree(tmp_path, monkeypatch):
+    """ Ensure a tree is merged into an existing destination."""
+
+    monkeypatch.setenv('FILER_COPY_WORKERS', '3')
+    for name in ('a/1.txt', 'a/b/2.txt', '3.txt', 'c/4.txt'):
+        (tmp_path / 'src' / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / 'src' / name).write_text(name)
+    (tmp_path / 'dst' / 'a').mkdir(parents=True)
+    (tmp_path / 'dst' / 'a' / 'keep.txt').write_text('keep')
+
+    copy_tree(str(tmp_path / 'src'), str(tmp_path / 'dst'))
+
+    for name in ('a/1.txt', 'a/b/2.txt', '3.txt', 'c/4.txt'):
+        assert (tmp_path / 'dst' / name).read_text() == name
+    assert (tmp_path / 'dst' / 'a' / 'keep.txt').read_text() == 'keep'
@@ -6,7 +6,7 @@ from tesk_core.filer import newTransput, FTPTransput, HTTPTransput, FileTransput
     subfolders_in
 from tesk_core.exception import UnknownProtocol, InvalidHostPath,\
     FileProtocolDisabled
-from tesk_core.path import containerPath
+from tesk_core.path import containerPath, directInput
 from tesk_core.filer_s3 import S3Transput
 from assertThrows import AssertThrowsMixin
 from fs.opener import open_fs
@@ -41,7 +41,7 @@ class FilerTest(unittest.TestCase, AssertThrowsMixin):
         logConfig(logging.DEBUG)  # Doesn't work...
 
     @patch('tesk_core.filer.copyDir')
-    @patch('tesk_core.filer.shutil.copy')
+    @patch('tesk_core.filer.copy_file')
     def test_download_file(self, copyMock, copyDirMock):
         filedata = {
             "url": "file:///home/tfga/workspace/cwl-tes/tmphrtip1o8/md5",
@@ -63,7 +63,7 @@ class FilerTest(unittest.TestCase, AssertThrowsMixin):
                                          '8fe4-341d5655af4b/md5')
 
     @patch('tesk_core.filer.copyDir')
-    @patch('tesk_core.filer.shutil.copy')
+    @patch('tesk_core.filer.copy_file')
     def test_download_dir(self, copyMock, copyDirMock):
         filedata = {
             "url": "file:///home/tfga/workspace/cwl-tes/tmphrtip1o8/",
@@ -79,7 +79,7 @@ class FilerTest(unittest.TestCase, AssertThrowsMixin):
         copyDirMock.assert_called_once_with('/transfer/tmphrtip1o8', '/TclSZU')
 
     @patch('tesk_core.filer.copyDir')
-    @patch('tesk_core.filer.shutil.copy')
+    @patch('tesk_core.filer.copy_file')
     def test_upload_dir(self, copyMock, copyDirMock):
         filedata = {
             "url": "file:///home/tfga/workspace/cwl-tes/tmphrtip1o8/",
@@ -208,6 +208,16 @@ class FilerTest(unittest.TestCase, AssertThrowsMixin):
                           "'HOST_BASE_PATH' (/home/tfga/workspace/cwl-tes)"
                           )
 
+    def test_directInput(self):
+        filedata = {'url': 'file:///home/tfga/workspace/cwl-tes/tmphrtip1o8/md5',
+                    'path': '/var/lib/cwl/md5', 'type': 'FILE'}
+        self.assertFalse(directInput(filedata))
+
+        with patch.dict(os.environ, {'FILER_DIRECT_FILE_INPUTS': '1'}):
+            self.assertTrue(directInput(filedata))
+            self.assertFalse(directInput(dict(filedata, url='http://foo/md5')))
+            self.assertFalse(directInput(dict(filedata, url='file:///other/md5')))
+
     def test_newTransput(self):
         self.assertEqual(newTransput('ftp', 'test.com'), FTPTransput)
         self.assertEqual(newTransput('http', 'test.com'), HTTPTransput)
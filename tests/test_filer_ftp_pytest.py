@@ -3,15 +3,19 @@
 from unittest import mock
 import ftplib
 import os
+import pytest
 
 from tesk_core.filer import (
     FTPTransput,
+    FTPConnectionPool,
     Type,
     ftp_login,
     ftp_upload_file,
     ftp_download_file,
     ftp_check_directory,
-    ftp_make_dirs
+    ftp_make_dirs,
+    ftp_list_dir,
+    FTPEntry
 )
 
 
@@ -81,6 +85,52 @@ def test_ftp_download_file_success(mocker, caplog):
         # assert os.path.exists('test_copy.py')
 
 
+def test_ftp_download_file_resumed(mocker):
+    """ Ensure a download with an offset appends to the local file and
+        asks the server to restart the transfer there."""
+
+    conn = mocker.patch('ftplib.FTP')
+    mock_retrbin = mocker.patch('ftplib.FTP.retrbinary')
+    with mock.patch('builtins.open', mock.mock_open(), create=False) as m:
+        assert 0 == ftp_download_file(conn,
+                                      'test_filer_ftp_pytest.py',
+                                      'test_copy.py.part',
+                                      1024)
+
+        mock_retrbin.assert_called_with(
+            "RETR " + "test_filer_ftp_pytest.py",
+            mock.ANY,
+            rest=1024
+        )
+
+        m.assert_called_with('test_copy.py.part', 'ab')
+
+
+@pytest.mark.parametrize('validator, offset', [
+    ('20200101000000 10', 4),
+    ('20190101000000 10', 0),
+])
+def test_ftp_transput_download_resumed(mocker, tmp_path, validator, offset):
+    """ Ensure a partial file is only continued while the remote file keeps
+        the modification time and size it was started from."""
+
+    mocker.patch.dict('os.environ', {'FILER_CHECKPOINT_DIR': str(tmp_path)})
+    path = str(tmp_path / 'file')
+    with open(path + '.part', 'wb') as file:
+        file.write(b'0123')
+    with open(path + '.part.validator', 'w') as file:
+        file.write(validator)
+    conn = mocker.MagicMock()
+    conn.size.return_value = 10
+    conn.voidcmd.return_value = '213 20200101000000'
+    mock_download = mocker.patch('tesk_core.filer.ftp_download_file',
+                                 side_effect=lambda c, r, local, o=0: open(local, 'ab').close())
+
+    ftp_obj = FTPTransput(path, 'ftp://ftp.foo.bar/file', Type.File, ftp_conn=conn)
+    assert ftp_obj.download_file() == 0
+    mock_download.assert_called_once_with(conn, '/file', path + '.part', offset)
+
+
 def test_ftp_upload_dir(mocker, fs, ftpserver):
     """ Check whether the upload of a directory through FTP completes
         successfully. """
@@ -193,6 +243,208 @@ def test_ftp_download_dir(mocker, tmpdir, tmp_path, ftpserver):
     assert os.path.exists(str(tmp_path) + 'downloads/remote1/remote2/file3')
 
 
+def test_ftp_pool_reuses_connections(mocker):
+    """ Ensure a released connection is handed out again for the same host
+        instead of logging in anew."""
+
+    mock_connect = mocker.patch('ftplib.FTP.connect')
+    mocker.patch('ftplib.FTP.voidcmd')
+    mock_login = mocker.patch('tesk_core.filer.ftp_login')
+
+    pool = FTPConnectionPool()
+    conn = pool.acquire('ftp.foo.bar', None)
+    pool.release('ftp.foo.bar', conn)
+
+    assert pool.acquire('ftp.foo.bar', None) is conn
+    mock_connect.assert_called_once_with('ftp.foo.bar')
+    mock_login.assert_called_once_with(conn, 'ftp.foo.bar', None)
+
+
+def test_ftp_pool_reconnects_stale_connection(mocker):
+    """ Ensure a connection failing its NOOP health check is replaced."""
+
+    mock_connect = mocker.patch('ftplib.FTP.connect')
+    mocker.patch('ftplib.FTP.voidcmd', side_effect=EOFError)
+    mock_close = mocker.patch('ftplib.FTP.close')
+    mocker.patch('tesk_core.filer.ftp_login')
+
+    pool = FTPConnectionPool()
+    stale = pool.acquire('ftp.foo.bar', None)
+    pool.release('ftp.foo.bar', stale)
+    conn = pool.acquire('ftp.foo.bar', None)
+
+    assert conn is not stale
+    mock_close.assert_called_once()
+    assert mock_connect.call_count == 2
+    assert pool.opened == {'ftp.foo.bar': 1}
+
+
+def test_ftp_pool_connection_cap(mocker):
+    """ Ensure no more than FILER_FTP_MAX_CONNECTIONS are opened to a
+        server."""
+
+    mocker.patch('ftplib.FTP.connect')
+    mocker.patch('tesk_core.filer.ftp_login')
+    mocker.patch.dict('os.environ', {'FILER_FTP_MAX_CONNECTIONS': '1'})
+
+    pool = FTPConnectionPool()
+    conn = pool.acquire('ftp.foo.bar', None)
+
+    assert pool.acquire('ftp.foo.bar', None, block=False) is None
+    assert pool.acquire('ftp.other.bar', None, block=False) is not None
+
+
+def test_ftp_upload_dir_parallel(mocker, tmp_path):
+    """ Ensure a directory upload shares its files out over several
+        connections."""
+
+    (tmp_path / 'dir1' / 'dir2').mkdir(parents=True)
+    for name in ['file1', 'file2', 'dir2/file3', 'dir2/file4']:
+        (tmp_path / 'dir1' / name).write_text(name)
+
+    mocker.patch.dict('os.environ', {'FILER_FTP_CONNECTIONS': '3'})
+    extra = [mocker.MagicMock(), mocker.MagicMock()]
+    mocker.patch('tesk_core.filer.ftp_pool.acquire', side_effect=extra)
+    mock_release = mocker.patch('tesk_core.filer.ftp_pool.release')
+    uploaded = []
+    mocker.patch('tesk_core.filer.FTPTransput.upload_file',
+                 autospec=True,
+                 side_effect=lambda t: uploaded.append(t.url_path) or 0)
+
+    ftp_obj = FTPTransput(str(tmp_path / 'dir1'), 'ftp://ftp.foo.bar/up',
+                          Type.Directory, ftp_conn=mocker.MagicMock())
+
+    assert ftp_obj.upload_dir() == 0
+    assert sorted(uploaded) == ['/up/dir2/file3', '/up/dir2/file4',
+                                '/up/file1', '/up/file2']
+    assert mock_release.call_count == 2
+
+
+def test_ftp_upload_dir_symlinks(mocker, tmp_path):
+    """ Ensure the contents of symlinked directories are uploaded too."""
+
+    (tmp_path / 'dir1').mkdir()
+    (tmp_path / 'elsewhere').mkdir()
+    (tmp_path / 'elsewhere' / 'file1').write_text('file1')
+    (tmp_path / 'dir1' / 'linked').symlink_to(tmp_path / 'elsewhere')
+
+    uploaded = []
+    mocker.patch('tesk_core.filer.FTPTransput.upload_file',
+                 autospec=True,
+                 side_effect=lambda t: uploaded.append(t.url_path) or 0)
+
+    ftp_obj = FTPTransput(str(tmp_path / 'dir1'), 'ftp://ftp.foo.bar/up',
+                          Type.Directory, ftp_conn=mocker.MagicMock())
+
+    assert ftp_obj.upload_dir() == 0
+    assert uploaded == ['/up/linked/file1']
+
+
+def test_ftp_list_dir_mlsd(mocker):
+    """ Ensure MLSD facts are parsed into entries, skipping the directory
+        itself and its parent."""
+
+    conn = mocker.MagicMock()
+    conn.mlsd_unsupported = False
+    lines = ['type=cdir;modify=20200101000000; .',
+             'type=pdir;modify=20200101000000; ..',
+             'type=file;size=14;modify=20200102030405; file 1.txt',
+             'type=dir;modify=20200101000000; sub']
+    conn.retrlines.side_effect = lambda cmd, callback: [callback(l) for l in lines]
+
+    assert ftp_list_dir(conn, '/remote') == [
+        FTPEntry('file 1.txt', False, 14, '20200102030405'),
+        FTPEntry('sub', True, None, '20200101000000'),
+    ]
+    conn.retrlines.assert_called_once_with('MLSD /remote', mock.ANY)
+    conn.cwd.assert_not_called()
+
+
+def test_ftp_list_dir_list_fallback(mocker, caplog):
+    """ Ensure servers without MLSD are listed with LIST, and unrecognised
+        lines are skipped instead of crashing."""
+
+    conn = mocker.MagicMock()
+    conn.mlsd_unsupported = False
+    lines = ['-rw-r--r--   1 owner    group          14 Jan 02  2020 file1',
+             'drwxr-xr-x   2 owner    group        4096 Jan 01 10:00 sub',
+             'total 8']
+
+    def retrlines(cmd, callback):
+        if cmd.startswith('MLSD'):
+            raise ftplib.error_perm('500 Unknown command')
+        for line in lines:
+            callback(line)
+
+    conn.retrlines.side_effect = retrlines
+
+    assert ftp_list_dir(conn, '/remote') == [
+        FTPEntry('file1', False, 14, None),
+        FTPEntry('sub', True, 4096, None),
+    ]
+    assert conn.mlsd_unsupported
+    conn.cwd.assert_called_once_with('/remote')
+    assert 'Skipping unrecognised LIST line: "total 8"' in caplog.text
+
+
+def test_ftp_destination_unchanged(mocker, tmp_path):
+    """ Ensure remote files with the local size and a newer MDTM count as
+        unchanged, and anything else as changed."""
+
+    local = tmp_path / 'result.txt'
+    local.write_text('same')
+    os.utime(str(local), (0, 0))
+    conn = mocker.MagicMock()
+    conn.size.return_value = 4
+    conn.voidcmd.return_value = '213 19700101000010'
+
+    ftp_obj = FTPTransput(str(local), 'ftp://ftp.foo.bar/out/result.txt',
+                          Type.File, ftp_conn=conn)
+    assert ftp_obj.destination_unchanged()
+    conn.size.assert_called_once_with('/out/result.txt')
+
+    conn.size.return_value = 5
+    assert not ftp_obj.destination_unchanged()
+
+    conn.size.side_effect = ftplib.error_perm('550 No such file')
+    assert not ftp_obj.destination_unchanged()
+
+
+def test_ftp_output_check(mocker, caplog):
+    """ Ensure an output passes its pre-flight check if the deepest existing
+        directory on its path can be entered."""
+
+    conn = mocker.MagicMock()
+    conn.cwd.side_effect = [ftplib.error_perm('550 No such directory'), None]
+
+    ftp_obj = FTPTransput('/tmp/result.txt', 'ftp://ftp.foo.bar/out/new/result.txt',
+                          Type.File, ftp_conn=conn)
+    assert 0 == ftp_obj.output_check()
+    assert conn.cwd.call_args_list == [mock.call('/out/new'), mock.call('/out')]
+
+    conn.cwd.side_effect = ftplib.error_perm('550 Permission denied')
+    assert 1 == ftp_obj.output_check()
+    assert 'Unable to change into any directory' in caplog.text
+
+
+def test_ftp_output_check_rejected_login(mocker, caplog):
+    """ Ensure wrong credentials fail the pre-flight check even if the
+        server lets the filer in anonymously instead."""
+
+    conn = mocker.MagicMock()
+    conn.login.side_effect = [ftplib.error_perm('530 Login incorrect'), None]
+    with mock.patch.dict('os.environ', {'TESK_FTP_USERNAME': 'test',
+                                        'TESK_FTP_PASSWORD': 'wrong'}):
+        ftp_login(conn, 'ftp.foo.bar', None)
+    assert conn.login.call_args_list == [mock.call('test', 'wrong'), mock.call()]
+
+    ftp_obj = FTPTransput('/tmp/result.txt', 'ftp://ftp.foo.bar/out/result.txt',
+                          Type.File, ftp_conn=conn)
+    assert 1 == ftp_obj.output_check()
+    assert 'configured FTP user was rejected' in caplog.text
+    conn.cwd.assert_not_called()
+
+
 def test_ftp_check_directory_error(mocker, caplog):
     """Ensure ftp_check_directory_error creates the proper error log
     message in case of error."""
@@ -220,7 +472,27 @@ def test_ftp_make_dirs_error(mocker, ftpserver, caplog):
     conn.connect(host=login_dict['host'], port=login_dict['port'])
     conn.login(login_dict['user'], login_dict['passwd'])
 
-    mocker.patch('ftplib.FTP.cwd', side_effect=ftplib.error_reply)
+    mocker.patch('ftplib.FTP.mkd', side_effect=ftplib.error_reply)
 
     assert ftp_make_dirs(conn, 'dir1') == 1
     assert 'Unable to create directory' in caplog.text
+
+
+def test_ftp_make_dirs_cached(mocker):
+    """ Ensure each remote directory is created at most once per connection
+        and files in freshly created directories skip the directory check."""
+
+    conn = mocker.MagicMock()
+    conn.mkd.side_effect = [None, ftplib.error_perm('550 exists'), None]
+
+    assert ftp_make_dirs(conn, '/out/run') == 0
+    assert ftp_make_dirs(conn, '/out/run') == 0
+    assert ftp_make_dirs(conn, '/out/other') == 0
+
+    assert conn.mkd.mock_calls == [mock.call('/out'), mock.call('/out/run'),
+                                   mock.call('/out/other')]
+    conn.cwd.assert_not_called()
+
+    assert ftp_check_directory(conn, '/out/other/file') == 1
+    assert ftp_check_directory(conn, '/out/run') == 0
+    conn.pwd.assert_not_called()
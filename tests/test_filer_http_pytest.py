@@ -1,11 +1,18 @@
 """Tests for 'filer.py' HTTP functionalities using 'pytest'."""
 
 from requests import Response, put
+import pytest
+import base64
+import hashlib
+import io
 import os
 from unittest import mock
 
+from tesk_core.checkpoint import partial_offset
 from tesk_core.filer import (
     HTTPTransput,
+    http_session,
+    input_size,
     Type
 )
 
@@ -20,12 +27,22 @@ resp = Response()
 resp._content = b'{ "foo" : "bar" }'
 
 
+def streamed_response(status_code, content=resp._content, headers=None):
+    """ Build a response whose body is read from a stream, like a real
+    'requests.get(..., stream=True)' response."""
+
+    response = Response()
+    response.status_code = status_code
+    response.raw = io.BytesIO(content)
+    response.headers.update(headers or {})
+    return response
+
+
 def test_download_file(mocker):
     """ Ensure a file gets properly downloaded."""
 
-    resp.status_code = SUCCESS
     http_obj = HTTPTransput(PATH_DOWN, URL, FTYPE)
-    mocker.patch('requests.get', return_value=resp)
+    mocker.patch('requests.Session.get', return_value=streamed_response(SUCCESS))
 
     with mock.patch(
             'builtins.open',
@@ -39,22 +56,293 @@ def test_download_file(mocker):
 def test_download_file_error(mocker, caplog):
     """ Ensure download error returns the correct value and log message."""
 
-    resp.status_code = FAIL
     http_obj = HTTPTransput(PATH_DOWN, URL, FTYPE)
-    mocker.patch('requests.get', return_value=resp)
+    mocker.patch('requests.Session.get', return_value=streamed_response(FAIL))
 
     assert 1 == http_obj.download_file()
     assert 'Got status code: {}'.format(FAIL) in caplog.text
 
 
+def test_download_file_unavailable(mocker):
+    """ Ensure a server error is reported as worth retrying."""
+
+    http_obj = HTTPTransput(PATH_DOWN, URL, FTYPE)
+    mocker.patch('requests.Session.get', return_value=streamed_response(503))
+
+    assert 1 == http_obj.download_file()
+    assert http_obj.transient
+
+
+def test_input_size(mocker):
+    """ Ensure inputs are sized with a HEAD, and missing ones reported."""
+
+    head = Response()
+    head.status_code = SUCCESS
+    head.headers.update({'Content-Length': '1234'})
+    mocker.patch('requests.Session.head', return_value=head)
+    assert HTTPTransput(PATH_DOWN, URL, Type.File).input_size() == (1234, 1)
+
+    head.status_code = 404
+    with pytest.raises(FileNotFoundError):
+        HTTPTransput(PATH_DOWN, URL, Type.File).input_size()
+
+    # Without the filer's credentials, a 404 may only mean "not for you"
+    filedata = {'url': URL, 'path': PATH_DOWN, 'type': 'FILE'}
+    assert input_size(filedata, same_credentials=False) == (None, None)
+    with pytest.raises(FileNotFoundError):
+        input_size(filedata)
+
+
+def test_download_file_streamed(mocker, fs):
+    """ Ensure a file is written chunk by chunk, with constant memory."""
+
+    content = b'0123456789' * 100
+    http_obj = HTTPTransput(PATH_DOWN, URL, FTYPE)
+    mocker.patch.dict('os.environ', {'FILER_HTTP_CHUNK_SIZE': '64'})
+    mock_get = mocker.patch('requests.Session.get', return_value=streamed_response(
+        SUCCESS, content, {'Content-Length': str(len(content))}))
+
+    assert 0 == http_obj.download_file()
+    mock_get.assert_called_once_with(URL, stream=True)
+    with open(PATH_DOWN, 'rb') as file:
+        assert file.read() == content
+
+
+def test_download_file_truncated(mocker, fs, caplog):
+    """ Ensure a body shorter than its Content-Length is an error."""
+
+    http_obj = HTTPTransput(PATH_DOWN, URL, FTYPE)
+    mocker.patch('requests.Session.get', return_value=streamed_response(
+        SUCCESS, b'short', {'Content-Length': '100'}))
+
+    assert 1 == http_obj.download_file()
+    assert 'incomplete' in caplog.text
+
+
+def test_download_file_segmented(mocker, tmp_path):
+    """ Ensure a large file is fetched as concurrent byte ranges when the
+    server supports them."""
+
+    content = bytes(range(256)) * 40
+    path = str(tmp_path / 'segmented.bin')
+    mocker.patch.dict('os.environ', {'FILER_HTTP_SEGMENTS': '4',
+                                     'FILER_HTTP_SEGMENT_MIN_SIZE': '1'})
+    head = Response()
+    head.status_code = SUCCESS
+    head.headers.update({'Accept-Ranges': 'bytes',
+                         'Content-Length': str(len(content)),
+                         'ETag': '"v1"'})
+    mocker.patch('requests.Session.head', return_value=head)
+
+    def get(url, headers, stream):
+        assert headers['If-Range'] == '"v1"'
+        start, end = map(int, headers['Range'][len('bytes='):].split('-'))
+        return streamed_response(206, content[start:end + 1])
+
+    mock_get = mocker.patch('requests.Session.get', side_effect=get)
+
+    assert 0 == HTTPTransput(path, URL, FTYPE).download_file()
+    assert mock_get.call_count == 4
+    with open(path, 'rb') as file:
+        assert file.read() == content
+
+
+def test_download_file_segments_changed(mocker, tmp_path):
+    """ Ensure ranges answered with the whole object, because it changed
+    since it was sized or ranges are ignored, make the download fall back to
+    a single stream instead of failing or mixing versions."""
+
+    content = bytes(range(256)) * 40
+    path = str(tmp_path / 'segmented.bin')
+    mocker.patch.dict('os.environ', {'FILER_HTTP_SEGMENTS': '4',
+                                     'FILER_HTTP_SEGMENT_MIN_SIZE': '1'})
+    head = Response()
+    head.status_code = SUCCESS
+    head.headers.update({'Accept-Ranges': 'bytes',
+                         'Content-Length': str(len(content)),
+                         'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+    mocker.patch('requests.Session.head', return_value=head)
+
+    def get(url, stream, headers=None):
+        if headers is not None:
+            assert headers['If-Range'] == 'Wed, 21 Oct 2015 07:28:00 GMT'
+        return streamed_response(SUCCESS, content)
+
+    mock_get = mocker.patch('requests.Session.get', side_effect=get)
+
+    assert 0 == HTTPTransput(path, URL, FTYPE).download_file()
+    assert mock_get.call_count == 5
+    mock_get.assert_called_with(URL, stream=True)
+    with open(path, 'rb') as file:
+        assert file.read() == content
+
+
+def test_download_file_interrupted(mocker, tmp_path):
+    """ Ensure an interrupted resumable download leaves a partial file of
+    the bytes received, not of the preallocated full size."""
+
+    mocker.patch.dict('os.environ', {'FILER_CHECKPOINT_DIR': str(tmp_path)})
+    path = str(tmp_path / 'file')
+    mocker.patch('requests.Session.get', return_value=streamed_response(
+        SUCCESS, b'0123', {'Content-Length': '10', 'ETag': '"v1"'}))
+
+    assert 1 == HTTPTransput(path, URL, FTYPE).download_file()
+    assert partial_offset(path) == 4
+
+
+def test_download_file_resumed(mocker, fs):
+    """ Ensure a resumable download continues a partial file with a Range
+    request and renames it into place once complete."""
+
+    mocker.patch.dict('os.environ', {'FILER_CHECKPOINT_DIR': '/checkpoint'})
+    with open(PATH_DOWN + '.part', 'wb') as file:
+        file.write(b'0123')
+    with open(PATH_DOWN + '.part.validator', 'w') as file:
+        file.write('"v1"')
+    mock_get = mocker.patch('requests.Session.get', return_value=streamed_response(
+        206, b'456789', {'Content-Length': '6'}))
+
+    assert 0 == HTTPTransput(PATH_DOWN, URL, FTYPE).download_file()
+    mock_get.assert_called_once_with(URL, stream=True,
+                                     headers={'Range': 'bytes=4-', 'If-Range': '"v1"'})
+    assert not os.path.exists(PATH_DOWN + '.part')
+    assert not os.path.exists(PATH_DOWN + '.part.validator')
+    with open(PATH_DOWN, 'rb') as file:
+        assert file.read() == b'0123456789'
+
+
+def test_download_file_resume_unvalidated(mocker, fs):
+    """ Ensure a partial file of unknown version is downloaded again, and the
+    version it is started from recorded."""
+
+    mocker.patch.dict('os.environ', {'FILER_CHECKPOINT_DIR': '/checkpoint'})
+    with open(PATH_DOWN + '.part', 'wb') as file:
+        file.write(b'stale')
+
+    mock_get = mocker.patch('requests.Session.get', return_value=streamed_response(
+        SUCCESS, headers={'ETag': '"v2"'}))
+    mock_start = mocker.patch('tesk_core.filer.start_partial')
+
+    assert 0 == HTTPTransput(PATH_DOWN, URL, FTYPE).download_file()
+    mock_get.assert_called_once_with(URL, stream=True)
+    mock_start.assert_called_once_with(PATH_DOWN, '"v2"')
+    with open(PATH_DOWN, 'rb') as file:
+        assert file.read() == resp._content
+
+
+def test_download_file_resume_gone(mocker, fs):
+    """ Ensure a 416 for a partial file already gone is a plain failure."""
+
+    mocker.patch.dict('os.environ', {'FILER_CHECKPOINT_DIR': '/checkpoint'})
+    mocker.patch('requests.Session.get', return_value=streamed_response(416))
+
+    assert 1 == HTTPTransput(PATH_DOWN, URL, FTYPE).download_file()
+
+
+def test_download_file_resume_ignored(mocker, fs):
+    """ Ensure a server answering a Range request with the whole file
+    replaces the partial file."""
+
+    mocker.patch.dict('os.environ', {'FILER_CHECKPOINT_DIR': '/checkpoint'})
+    with open(PATH_DOWN + '.part', 'wb') as file:
+        file.write(b'stale')
+    mocker.patch('requests.Session.get', return_value=streamed_response(SUCCESS))
+
+    assert 0 == HTTPTransput(PATH_DOWN, URL, FTYPE).download_file()
+    with open(PATH_DOWN, 'rb') as file:
+        assert file.read() == resp._content
+
+
+def test_download_file_ranges_unsupported(mocker, fs):
+    """ Ensure servers without range support get a single streamed GET."""
+
+    mocker.patch.dict('os.environ', {'FILER_HTTP_SEGMENTS': '4',
+                                     'FILER_HTTP_SEGMENT_MIN_SIZE': '1'})
+    head = Response()
+    head.status_code = SUCCESS
+    head.headers.update({'Content-Length': str(len(resp._content))})
+    mocker.patch('requests.Session.head', return_value=head)
+    mock_get = mocker.patch('requests.Session.get',
+                            return_value=streamed_response(SUCCESS))
+
+    assert 0 == HTTPTransput(PATH_DOWN, URL, FTYPE).download_file()
+    mock_get.assert_called_once_with(URL, stream=True)
+
+
 def test_upload_file(mocker):
     """ Ensure a file gets properly uploaded."""
 
     resp.status_code = SUCCESS
     http_obj = HTTPTransput(PATH_UP, URL, FTYPE)
-    mocker.patch('requests.put', return_value=resp)
+    mocker.patch('requests.Session.put', return_value=resp)
+
+    assert 0 == http_obj.upload_file()
+
+
+def test_upload_file_binary(mocker, fs):
+    """ Ensure binary files are uploaded as an open binary stream."""
+
+    content = bytes(range(256))
+    fs.create_file('binary.bam', contents=content)
+    resp.status_code = SUCCESS
+    http_obj = HTTPTransput('binary.bam', URL, FTYPE)
+    mock_put = mocker.patch('requests.Session.put', return_value=resp)
 
     assert 0 == http_obj.upload_file()
+    data = mock_put.call_args[1]['data']
+    assert 'b' in data.mode
+    assert data.name == 'binary.bam'
+
+
+def test_upload_file_sync_unchanged(mocker, fs):
+    """ Ensure an unchanged file is not uploaded again in sync mode."""
+
+    fs.create_file('result.txt', contents='same')
+    os.utime('result.txt', (0, 0))
+    mocker.patch.dict('os.environ', {'FILER_SYNC_OUTPUTS': '1'})
+    head = Response()
+    head.status_code = SUCCESS
+    head.headers.update({'Content-Length': '4',
+                         'Last-Modified': 'Thu, 01 Jan 1970 00:00:10 GMT'})
+    mocker.patch('requests.Session.head', return_value=head)
+    mock_put = mocker.patch('requests.Session.put')
+
+    assert 0 == HTTPTransput('result.txt', URL, Type.File).upload()
+    mock_put.assert_not_called()
+
+    head.headers['Content-Length'] = '5'
+    mock_put.return_value = resp
+    resp.status_code = SUCCESS
+    assert 0 == HTTPTransput('result.txt', URL, Type.File).upload()
+    mock_put.assert_called_once()
+
+
+def test_upload_file_sync_rerun(mocker, fs):
+    """ Ensure a rerun's output is skipped when its MD5 matches the remote one."""
+
+    fs.create_file('result.txt', contents='same')
+    mocker.patch.dict('os.environ', {'FILER_SYNC_OUTPUTS': '1'})
+    head = Response()
+    head.status_code = SUCCESS
+    head.headers.update({'Content-Length': '4',
+                         'Last-Modified': 'Thu, 01 Jan 1970 00:00:10 GMT',
+                         'ETag': '"{}"'.format(hashlib.md5(b'same').hexdigest())})
+    mocker.patch('requests.Session.head', return_value=head)
+    mock_put = mocker.patch('requests.Session.put')
+
+    assert 0 == HTTPTransput('result.txt', URL, Type.File).upload()
+    mock_put.assert_not_called()
+
+    del head.headers['ETag']
+    head.headers['Content-MD5'] = base64.b64encode(hashlib.md5(b'same').digest()).decode()
+    assert 0 == HTTPTransput('result.txt', URL, Type.File).upload()
+    mock_put.assert_not_called()
+
+    head.headers['Content-MD5'] = base64.b64encode(hashlib.md5(b'diff').digest()).decode()
+    mock_put.return_value = resp
+    resp.status_code = SUCCESS
+    assert 0 == HTTPTransput('result.txt', URL, Type.File).upload()
+    mock_put.assert_called_once()
 
 
 def test_upload_file_error(mocker, caplog):
@@ -62,12 +350,22 @@ def test_upload_file_error(mocker, caplog):
 
     resp.status_code = FAIL
     http_obj = HTTPTransput(PATH_UP, URL, FTYPE)
-    mocker.patch('requests.put', return_value=resp)
+    mocker.patch('requests.Session.put', return_value=resp)
 
     assert 1 == http_obj.upload_file()
     assert 'Got status code: {}'.format(FAIL) in caplog.text
 
 
+def test_http_session_shared():
+    """ Ensure all HTTP transfers reuse one pooled session."""
+
+    session = http_session()
+    assert session is http_session()
+    adapter = session.get_adapter(URL)
+    assert adapter.max_retries.total == 3
+    assert adapter is session.get_adapter('https://www.foo.bar')
+
+
 def test_upload_dir(mocker, fs):
     """ Ensure that each file inside nexted directories gets successfully
     uploaded."""
@@ -83,7 +381,14 @@ def test_upload_dir(mocker, fs):
     fs.create_file('dir1/dir2/file4.txt', contents="took me a while")
 
 
-    mock_put = mocker.patch('requests.put', return_value=resp)
+    # Files are streamed, so record what was read from them during the call
+    uploaded = {}
+
+    def put(url, data):
+        uploaded[url] = data.read()
+        return resp
+
+    mocker.patch('requests.Session.put', side_effect=put)
 
     http_obj = HTTPTransput(
         "dir1",
@@ -93,13 +398,11 @@ def test_upload_dir(mocker, fs):
 
     assert http_obj.upload_dir() == 0
 
-    # We emply the 'list.sorted' trick to ignore calls order because the
-    # 'assert_has_calls' method would not work in this setting
-    assert sorted(mock_put.mock_calls) == sorted([
-        mock.call(endpoint + '/dir1/dir2/file2', data="not really"),
-        mock.call(endpoint + '/dir1/dir2/file4.txt', data="took me a while"),
-        mock.call(endpoint + '/dir1/file1', data="this is random"),
-    ])
+    assert uploaded == {
+        endpoint + '/dir1/dir2/file2': b"not really",
+        endpoint + '/dir1/dir2/file4.txt': b"took me a while",
+        endpoint + '/dir1/file1': b"this is random",
+    }
 
 
     def test_upload_dir_error(mocker, fs):
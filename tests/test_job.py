@@ -6,6 +6,8 @@ from unittest.mock import patch
 from dateutil.tz import tzutc
 from tesk_core import taskmaster
 from tesk_core.job import Job
+from tesk_core.pvc import PVC
+from tesk_core.kube_client import new_api_client
 from argparse import Namespace
 from datetime import timezone
 from kubernetes.client.rest import ApiException
@@ -119,6 +121,16 @@ def list_namespaced_pod_pending_unknown_error(diff_time=5):
             "start_time": START_TIME- datetime.timedelta(minutes=diff_time)}}
     return MockObject({"items":[MockObject(return_value)]})
 
+def pending_pod(waiting=None, conditions=(), diff_time=0):
+    statuses = [MockObject({"name": "task-1000-ex-00",
+                            "state": {"running": None, "terminated": None, "waiting": waiting}})]
+    return MockObject({"metadata": {"name": "task-1000-ex-00-abcde"},
+                       "status": {"conditions": list(conditions),
+                                  "container_statuses": statuses,
+                                  "init_container_statuses": None,
+                                  "phase": "Pending",
+                                  "start_time": START_TIME - datetime.timedelta(minutes=diff_time)}})
+
 class JobTestCase(unittest.TestCase):
     def setUp(self):
         """
@@ -197,6 +209,82 @@ class JobTestCase(unittest.TestCase):
                 job.run_to_completion(taskmaster.args.poll_interval, taskmaster.check_cancelled,
                                                taskmaster.args.pod_timeout)
 
+    @patch("tesk_core.taskmaster.check_cancelled", return_value=False)
+    @patch("kubernetes.client.BatchV1Api.create_namespaced_job")
+    @patch("kubernetes.client.BatchV1Api.read_namespaced_job", side_effect=read_namespaced_job_running)
+    @patch("kubernetes.watch.Watch.stream")
+    def test_run_to_completion_watch(self, mock_stream, mock_read_namespaced_job, mock_create_namespaced_job,
+                                     mock_check_cancelled):
+        """
+        Checking if a watched Job completes as soon as the watch reports a condition, without polling it again
+        """
+        job_complete = read_namespaced_job_success('task-1000-ex-00', 'default')
+        job_complete.metadata = MockObject({'resource_version': '42'})
+        mock_stream.return_value = iter([{'type': 'MODIFIED', 'object': job_complete}])
+        executor = self.data['executors'][0]
+        job = Job(executor, executor['metadata']['name'], taskmaster.args.namespace)
+        status = job.run_to_completion(1, taskmaster.check_cancelled, taskmaster.args.pod_timeout, 30)
+        self.assertEqual(status, "Complete")
+        self.assertEqual(job.resource_version, '42')
+        mock_read_namespaced_job.assert_called_once()
+
+    @patch("kubernetes.client.CoreV1Api.list_namespaced_pod")
+    @patch("kubernetes.client.BatchV1Api.read_namespaced_job")
+    def test_get_job_status_pod_check_interval(self, mock_read_namespaced_job, mock_list_namespaced_pod):
+        """
+        Checking if pending pods are listed at most once per pod check interval
+        """
+        mock_read_namespaced_job.return_value = read_namespaced_job_pending(0)
+        mock_list_namespaced_pod.return_value = MockObject({"items": [pending_pod(
+            {"reason": "ContainerCreating", "message": None})]})
+        executor = self.data['executors'][0]
+        job = Job(executor, executor['metadata']['name'], taskmaster.args.namespace)
+
+        self.assertEqual(job.get_status(False), ("Running", False))
+        self.assertEqual(job.get_status(False), ("Running", False))
+        mock_list_namespaced_pod.assert_called_once()
+
+        job.pods_checked_at -= job.pod_check_interval
+        job.get_status(False)
+        self.assertEqual(mock_list_namespaced_pod.call_count, 2)
+
+    @patch("kubernetes.client.rest.RESTClientObject.request")
+    def test_wait_for_update_query(self, mock_request):
+        """
+        Checking if the watch only asks for a resourceVersion once it has seen one
+        """
+        job_event = {'type': 'MODIFIED', 'object': {'kind': 'Job', 'metadata': {
+            'name': 'task-1000-ex-00', 'resourceVersion': '42'}, 'status': {}}}
+        mock_request.return_value.read_chunked.side_effect = \
+            lambda *args, **kwargs: iter([json.dumps(job_event).encode('utf-8') + b'\n'])
+        executor = self.data['executors'][0]
+        job = Job(executor, executor['metadata']['name'], taskmaster.args.namespace)
+
+        job.wait_for_update(30, 1)
+        query = dict(mock_request.call_args[1]['query_params'])
+        self.assertNotIn('resourceVersion', query)
+        self.assertEqual(query['watch'], True)
+        self.assertEqual(job.resource_version, '42')
+
+        job.wait_for_update(30, 1)
+        query = dict(mock_request.call_args[1]['query_params'])
+        self.assertEqual(query['resourceVersion'], '42')
+
+    @patch("time.sleep")
+    @patch("kubernetes.watch.Watch.stream")
+    def test_wait_for_update_expired(self, mock_stream, mock_sleep):
+        """
+        Checking if an expired resourceVersion makes the watch fall back to polling
+        """
+        mock_stream.return_value = iter([{'type': 'ERROR', 'object': None,
+                                          'raw_object': {'code': 410, 'reason': 'Gone'}}])
+        executor = self.data['executors'][0]
+        job = Job(executor, executor['metadata']['name'], taskmaster.args.namespace)
+        job.resource_version = '42'
+        self.assertIsNone(job.wait_for_update(30, 1))
+        self.assertIsNone(job.resource_version)
+        mock_sleep.assert_called_once_with(1)
+
     @patch("kubernetes.client.CoreV1Api.list_namespaced_pod")
     @patch("kubernetes.client.BatchV1Api.read_namespaced_job", side_effect=read_namespaced_job_error)
     @patch("tesk_core.job.Job.delete")
@@ -284,5 +372,97 @@ class JobTestCase(unittest.TestCase):
         self.assertEqual(status, "Running")
 
 
+    @patch("kubernetes.client.CoreV1Api.list_namespaced_pod")
+    @patch("kubernetes.client.BatchV1Api.read_namespaced_job")
+    def test_get_job_status_hopeless_pod(self, mock_read_namespaced_job, mock_list_namespaced_pod):
+        """
+        Checking if pods that can never start fail the job at once, with the reason
+        """
+        mock_read_namespaced_job.return_value = read_namespaced_job_pending(0)
+        executor = self.data['executors'][0]
+        job = Job(executor, executor['metadata']['name'], taskmaster.args.namespace)
+        job.pod_check_interval = 0
+        for reason, message in [('InvalidImageName', 'couldn\'t parse image reference'),
+                                ('CreateContainerConfigError', 'secret "netrc" not found'),
+                                ('ErrImagePull', 'manifest unknown: manifest unknown')]:
+            mock_list_namespaced_pod.return_value = MockObject({"items": [pending_pod(
+                {"reason": reason, "message": message})]})
+            status, all_pods_running = job.get_status(False)
+            self.assertEqual(status, "Error")
+            self.assertEqual(job.reason, reason + ': ' + message)
+
+        # A registry timeout may go away
+        mock_list_namespaced_pod.return_value = MockObject({"items": [pending_pod(
+            {"reason": "ErrImagePull", "message": "i/o timeout"})]})
+        self.assertEqual(job.get_status(False)[0], "Running")
+
+    @patch("kubernetes.client.CoreV1Api.list_namespaced_event")
+    @patch("kubernetes.client.CoreV1Api.list_namespaced_pod")
+    @patch("kubernetes.client.BatchV1Api.read_namespaced_job")
+    def test_get_job_status_stuck_pod(self, mock_read_namespaced_job, mock_list_namespaced_pod,
+                                      mock_list_namespaced_event):
+        """
+        Checking if unschedulable pods and pods with failing mounts fail the job once pending
+        for the pod timeout
+        """
+        mock_read_namespaced_job.return_value = read_namespaced_job_pending(10)
+        unschedulable = MockObject({"type": "PodScheduled", "status": "False", "reason": "Unschedulable",
+                                    "message": "pod has unbound immediate PersistentVolumeClaims"})
+        executor = self.data['executors'][0]
+        job = Job(executor, executor['metadata']['name'], taskmaster.args.namespace)
+        job.pod_check_interval = 0
+
+        mock_list_namespaced_pod.return_value = MockObject({"items": [pending_pod(
+            conditions=[unschedulable], diff_time=1)]})
+        self.assertEqual(job.get_status(False)[0], "Running")
+
+        mock_list_namespaced_pod.return_value = MockObject({"items": [pending_pod(
+            conditions=[unschedulable], diff_time=10)]})
+        self.assertEqual(job.get_status(False)[0], "Error")
+        self.assertEqual(job.reason, "Unschedulable: pod has unbound immediate PersistentVolumeClaims")
+
+        mock_list_namespaced_pod.return_value = MockObject({"items": [pending_pod(
+            {"reason": "ContainerCreating", "message": None}, diff_time=10)]})
+        mock_list_namespaced_event.return_value = MockObject({"items": [
+            MockObject({"type": "Warning", "reason": "FailedMount", "message": "volume not found",
+                        "last_timestamp": START_TIME}),
+            MockObject({"type": "Warning", "reason": "FailedScheduling", "message": "no nodes",
+                        "last_timestamp": START_TIME - datetime.timedelta(minutes=5)})]})
+        self.assertEqual(job.get_status(False)[0], "Error")
+        self.assertEqual(job.reason, "FailedMount: volume not found")
+
+        # A pod slowly pulling its image after a scale-up is not stuck
+        mock_list_namespaced_event.return_value = MockObject({"items": [
+            MockObject({"type": "Warning", "reason": "FailedMount", "message": "volume not found",
+                        "last_timestamp": START_TIME - datetime.timedelta(minutes=20)}),
+            MockObject({"type": "Warning", "reason": "FailedScheduling", "message": "no nodes",
+                        "last_timestamp": START_TIME})]})
+        self.assertEqual(job.get_status(False)[0], "Running")
+        mock_list_namespaced_event.assert_called_with(
+            'default', field_selector='involvedObject.name=task-1000-ex-00-abcde')
+
+    @patch.dict(os.environ, {"KUBE_API_POOL_SIZE": "8", "KUBE_API_CONNECT_TIMEOUT": "5"})
+    def test_shared_api_client(self):
+        """
+        Checking that Job and PVC objects talk through the ApiClient they are given
+        """
+        api_client = new_api_client()
+        self.assertEqual(api_client.configuration.connection_pool_maxsize, 8)
+        self.assertEqual(api_client.rest_client.pool_manager.connection_pool_kw['maxsize'], 8)
+        self.assertEqual(api_client.connect_timeout, 5)
+
+        executor = self.data['executors'][0]
+        job = Job(executor, executor['metadata']['name'], taskmaster.args.namespace, api_client)
+        pvc = PVC('task-pvc', 1, taskmaster.args.namespace, api_client)
+        self.assertIs(job.bv1.api_client, api_client)
+        self.assertIs(job.cv1.api_client, api_client)
+        self.assertIs(pvc.cv1.api_client, api_client)
+
+        with patch.object(api_client.rest_client, 'DELETE') as mock_delete:
+            mock_delete.return_value.data = '{}'
+            pvc.delete()
+        self.assertEqual(mock_delete.call_args[1]['_request_timeout'], (5, None))
+
+
 if __name__ == '__main__':
     unittest.main()
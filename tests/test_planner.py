@@ -0,0 +1,52 @@
+"""Tests for the transfer planner using 'pytest'."""
+
+from tesk_core.planner import plan_transfers, check_destinations
+
+
+def entry(name):
+    return {'path': '/data/' + name, 'url': 'http://foo/' + name, 'type': 'FILE'}
+
+
+def test_plan_transfers():
+    """ Ensure sizes are summed and attached to the entries."""
+
+    sizes = {'http://foo/a': (10, 1), 'http://foo/dir': (30, 3), 'http://foo/b': (None, None)}
+    transfers = [entry('a'), entry('dir'), entry('b')]
+
+    plan = plan_transfers(transfers, lambda filedata: sizes[filedata['url']])
+
+    assert (plan.bytes, plan.files, plan.unknown, plan.missing) == (40, 4, 1, [])
+    assert [filedata.get('size') for filedata in transfers] == [10, 30, None]
+
+
+def test_plan_transfers_missing(caplog):
+    """ Ensure missing inputs are reported, and errors only make sizes
+    unknown."""
+
+    def size_of(filedata):
+        if filedata['url'] == 'http://foo/missing':
+            raise FileNotFoundError('Got status code: 404')
+        if filedata['url'] == 'http://foo/denied':
+            raise PermissionError()
+        return 1, 1
+
+    transfers = [entry('missing'), entry('denied')]
+    plan = plan_transfers(transfers, size_of, workers=1)
+
+    assert plan.missing == [transfers[0]]
+    assert 'Input http://foo/missing does not exist' in caplog.text
+
+
+def test_check_destinations(caplog):
+    """ Ensure failing and raising checks both fail their destination."""
+
+    def check(filedata):
+        if filedata['url'] == 'http://foo/denied':
+            return 1
+        if filedata['url'] == 'http://foo/down':
+            raise ConnectionError()
+        return 0
+
+    transfers = [entry('ok'), entry('denied'), entry('down')]
+    assert check_destinations(transfers, check) == transfers[1:]
+    assert 'Output destination http://foo/denied failed' in caplog.text
@@ -0,0 +1,99 @@
+"""Tests for the filer's retry layer using 'pytest'."""
+
+import ftplib
+import pytest
+import botocore.exceptions
+import requests
+import urllib3.exceptions
+
+from tesk_core import retry
+from tesk_core.retry import retrying, is_transient, RetryBudget
+
+
+@pytest.fixture(autouse=True)
+def fresh_budget(monkeypatch):
+    monkeypatch.setattr(retry, '_budget', RetryBudget(10))
+
+
+def outcomes(*results):
+    """ An operation returning (or raising) 'results' one after the other."""
+
+    results = list(results)
+    calls = []
+
+    def operation():
+        calls.append(1)
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    operation.calls = calls
+    return operation
+
+
+def client_error(code):
+    return botocore.exceptions.ClientError({'Error': {'Code': code}}, 'GetObject')
+
+
+def test_is_transient():
+    """ Ensure dropped connections and throttling are retried, but not
+    missing files or denied access."""
+
+    assert is_transient(requests.ConnectionError())
+    reset = urllib3.exceptions.ProtocolError('Connection broken', ConnectionResetError(104, 'reset'))
+    assert is_transient(reset)
+    assert is_transient(requests.exceptions.ChunkedEncodingError(reset))
+    assert is_transient(ftplib.error_temp('421 Too many connections'))
+    assert is_transient(client_error('SlowDown'))
+    assert not is_transient(client_error('NoSuchKey'))
+    assert not is_transient(ftplib.error_perm('550 No such file'))
+    assert not is_transient(ValueError())
+
+
+def test_retrying_transient(caplog):
+    """ Ensure transient failures are retried until the transfer succeeds."""
+
+    dropped = requests.exceptions.ChunkedEncodingError(urllib3.exceptions.ProtocolError(
+        'Connection broken', ConnectionResetError(104, 'reset')))
+    operation = outcomes((1, True), requests.ConnectionError('reset'), dropped, (0, False))
+    delays = []
+
+    assert retrying(operation, 'http://foo/a', sleep=delays.append) == 0
+    assert len(operation.calls) == 4
+    assert len(delays) == 3
+    assert 'Retrying http://foo/a' in caplog.text
+
+
+def test_retrying_permanent():
+    """ Ensure permanent failures are reported at once."""
+
+    operation = outcomes((1, False))
+    assert retrying(operation, 'http://foo/a', sleep=pytest.fail) == 1
+    assert len(operation.calls) == 1
+
+    with pytest.raises(ValueError):
+        retrying(outcomes(ValueError()), 'http://foo/a', sleep=pytest.fail)
+
+
+def test_retrying_limits(monkeypatch, caplog):
+    """ Ensure a transfer gives up after FILER_RETRIES, and all transfers
+    once the budget is spent."""
+
+    monkeypatch.setenv('FILER_RETRIES', '2')
+    operation = outcomes(*[(1, True)] * 3)
+    assert retrying(operation, 'http://foo/a', sleep=lambda delay: None) == 1
+    assert len(operation.calls) == 3
+    assert 'Giving up on http://foo/a after 3 attempts' in caplog.text
+
+    monkeypatch.setattr(retry, '_budget', RetryBudget(1))
+    operation = outcomes(*[(1, True)] * 3)
+    assert retrying(operation, 'http://foo/b', sleep=lambda delay: None) == 1
+    assert len(operation.calls) == 2
+
+
+def test_backoff_delay():
+    """ Ensure delays grow exponentially up to the cap."""
+
+    for attempt in range(10):
+        assert 0 <= retry.backoff_delay(attempt, 1, 30) <= min(30, 2 ** attempt)
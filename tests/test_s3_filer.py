@@ -1,10 +1,24 @@
 import os
+import hashlib
 import pytest
 import boto3
-from tesk_core.filer_s3 import S3Transput
+import botocore.exceptions
+from tesk_core import filer_s3
+from tesk_core.filer_s3 import S3Transput, s3_resource, list_s3_objects, s3_transfer_config, MB, \
+    s3_etag, wait_for_transfers
 #from tesk_core.extract_endpoint import extract_endpoint
 from moto import mock_s3
-from unittest.mock import patch, mock_open
+from unittest.mock import patch, mock_open, MagicMock
+
+@pytest.fixture(autouse=True)
+def clear_s3_caches():
+    """
+    The S3 clients and verified buckets are cached per run; start every test afresh
+    """
+    filer_s3._s3_resources.clear()
+    filer_s3._verified_buckets.clear()
+    yield
+
 
 @pytest.fixture()
 def moto_boto():
@@ -44,6 +58,45 @@ def test_check_if_bucket_exists(moto_boto, path, url, ftype, expected):
         trans = S3Transput(path, url, ftype)
         assert trans.check_if_bucket_exists(client) == expected
 
+def test_s3_resource_shared(moto_boto):
+        """
+        Check if all transfers share one S3 client, each through a resource of its own,
+        and check each bucket only once
+        """
+        first, second = s3_resource("http://s3.amazonaws.com"), s3_resource("http://s3.amazonaws.com")
+        assert first is not second
+        assert first.meta.client is second.meta.client
+        client = s3_resource("http://s3.amazonaws.com")
+        trans = S3Transput("/home/user/filer_test/file.txt", "s3://tesk/folder/file.txt", "FILE")
+        with patch.object(client.meta.client, 'head_bucket') as mock_head_bucket:
+            assert trans.check_if_bucket_exists(client) == 0
+            assert trans.check_if_bucket_exists(client) == 0
+        mock_head_bucket.assert_called_once_with(Bucket='tesk')
+
+def test_s3_transfer_config_defaults():
+        """
+        Check if part sizes grow with the object size, keeping to 1000 parts
+        """
+        assert s3_transfer_config().multipart_chunksize == 8 * MB
+        assert s3_transfer_config(1024 * MB).multipart_chunksize == 8 * MB
+        config = s3_transfer_config(100 * 1024 * MB)
+        assert config.multipart_chunksize == -(-100 * 1024 * MB // 1000)
+        assert config.multipart_threshold == config.multipart_chunksize
+        assert s3_transfer_config(10 ** 13).multipart_chunksize == 5 * 1024 * MB
+
+@patch.dict(os.environ, {"FILER_S3_WORKERS": "32", "FILER_S3_MULTIPART_CHUNKSIZE": str(64 * MB),
+                         "FILER_S3_MAX_IO_QUEUE": "1000", "FILER_S3_USE_THREADS": "0"})
+def test_s3_transfer_config_env():
+        """
+        Check if the FILER_S3_* settings override the defaults
+        """
+        config = s3_transfer_config(100 * 1024 * MB)
+        assert config.max_request_concurrency == 32
+        assert config.multipart_chunksize == 64 * MB
+        assert config.multipart_threshold == 64 * MB
+        assert config.max_io_queue_size == 1000
+        assert config.use_threads is False
+
 # @patch('tesk_core.filer.os.makedirs')
 # @patch('builtins.open')
 # @patch('s3transfer.utils.OSUtils.rename_file')
@@ -90,6 +143,63 @@ def test_s3_download_directory( mock_makedirs, mock_open, mock_rename, path, url
             mock_rename.assert_called_once_with('filer_test/folder2', exist_ok=True)
 
 
+def test_list_s3_objects_paginated():
+    """
+    Check if listings longer than one page are followed to their end
+    """
+    client = MagicMock()
+    client.list_objects_v2.side_effect = [
+        {'Contents': [{'Key': 'a'}, {'Key': 'b'}], 'IsTruncated': True, 'NextContinuationToken': 'next'},
+        {'Contents': [{'Key': 'c'}], 'IsTruncated': False},
+    ]
+    assert [obj['Key'] for obj in list_s3_objects(client, 'tesk', 'folder/')] == ['a', 'b', 'c']
+    client.list_objects_v2.assert_called_with(Bucket='tesk', Prefix='folder/', ContinuationToken='next')
+
+
+def test_s3_download_directory_nested(moto_boto, tmp_path):
+    """
+    Check if every object under a prefix is downloaded to its relative path
+    """
+    client = boto3.resource('s3', endpoint_url="http://s3.amazonaws.com")
+    client.Bucket('tesk').put_object(Key='run/a.txt', Body='a')
+    client.Bucket('tesk').put_object(Key='run/sub/b.txt', Body='b')
+    with S3Transput(str(tmp_path), "s3://tesk/run", "DIRECTORY") as trans:
+        assert trans.download_dir() == 0
+    assert (tmp_path / 'a.txt').read_text() == 'a'
+    assert (tmp_path / 'sub' / 'b.txt').read_text() == 'b'
+
+
+def test_s3_download_file_resumed(moto_boto, tmp_path, monkeypatch):
+    """
+    Check if a resumable download continues its partial file with a ranged GET
+    """
+    monkeypatch.setenv('FILER_CHECKPOINT_DIR', str(tmp_path))
+    client = boto3.resource('s3', endpoint_url="http://s3.amazonaws.com")
+    client.Bucket('tesk').put_object(Key='run/big.bin', Body=b'0123456789')
+    path = tmp_path / 'big.bin'
+    (tmp_path / 'big.bin.part').write_bytes(b'abcd')
+    (tmp_path / 'big.bin.part.validator').write_text(client.Object('tesk', 'run/big.bin').e_tag)
+    with S3Transput(str(path), "s3://tesk/run/big.bin", "FILE") as trans:
+        assert trans.download_file() == 0
+    assert path.read_bytes() == b'abcd456789'
+    assert not (tmp_path / 'big.bin.part').exists()
+
+
+def test_s3_download_file_resume_changed(moto_boto, tmp_path, monkeypatch):
+    """
+    Check if a partial file of another version of the object is downloaded again
+    """
+    monkeypatch.setenv('FILER_CHECKPOINT_DIR', str(tmp_path))
+    client = boto3.resource('s3', endpoint_url="http://s3.amazonaws.com")
+    client.Bucket('tesk').put_object(Key='run/big.bin', Body=b'0123456789')
+    path = tmp_path / 'big.bin'
+    (tmp_path / 'big.bin.part').write_bytes(b'abcd')
+    (tmp_path / 'big.bin.part.validator').write_text('"an older version"')
+    with S3Transput(str(path), "s3://tesk/run/big.bin", "FILE") as trans:
+        assert trans.download_file() == 0
+    assert path.read_bytes() == b'0123456789'
+
+
 @pytest.mark.parametrize("path, url, ftype,expected", [
         ("/home/user/filer_test/file.txt", "s3://tesk/folder/file.txt","FILE",0),
         ("/home/user/filer_test/file_new.txt", "s3://tesk/folder/file.txt","FILE",1),
@@ -135,6 +245,96 @@ def test_s3_upload_directory(path, url, ftype, expected, moto_boto, caplog):
         '''
         assert client.Object('tesk', 'folder1/folder2/test_filer.py').load() == None
 
+def test_s3_upload_directory_nested(moto_boto, tmp_path):
+    """
+        Checking if a nested directory is uploaded with keys relative to it
+    """
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'a.txt').write_text('a')
+    (tmp_path / 'sub' / 'b.txt').write_text('b')
+    client = boto3.resource('s3', endpoint_url="http://s3.amazonaws.com")
+    trans = S3Transput(str(tmp_path), "s3://tesk/out", "DIRECTORY")
+    trans.bucket_obj = client.Bucket(trans.bucket)
+    assert trans.upload_dir() == 0
+    keys = sorted(obj.key for obj in client.Bucket('tesk').objects.filter(Prefix='out/'))
+    assert keys == ['out/a.txt', 'out/sub/b.txt']
+
+def test_s3_upload_directory_symlinks(moto_boto, tmp_path):
+    """
+        Checking if the contents of symlinked directories are uploaded too
+    """
+    (tmp_path / 'out').mkdir()
+    (tmp_path / 'elsewhere').mkdir()
+    (tmp_path / 'elsewhere' / 'a.txt').write_text('a')
+    (tmp_path / 'out' / 'linked').symlink_to(tmp_path / 'elsewhere')
+    client = boto3.resource('s3', endpoint_url="http://s3.amazonaws.com")
+    trans = S3Transput(str(tmp_path / 'out'), "s3://tesk/out", "DIRECTORY")
+    trans.bucket_obj = client.Bucket(trans.bucket)
+    assert trans.upload_dir() == 0
+    keys = sorted(obj.key for obj in client.Bucket('tesk').objects.filter(Prefix='out/'))
+    assert keys == ['out/linked/a.txt']
+
+@patch.dict(os.environ, {"FILER_SYNC_OUTPUTS": "1"})
+def test_s3_upload_directory_sync(moto_boto, tmp_path):
+    """
+        Checking if files already uploaded unchanged are skipped with FILER_SYNC_OUTPUTS
+    """
+    (tmp_path / 'a.txt').write_text('a')
+    (tmp_path / 'b.txt').write_text('b')
+    client = boto3.resource('s3', endpoint_url="http://s3.amazonaws.com")
+    client.Bucket('tesk').put_object(Key='out/a.txt', Body='a')
+    client.Bucket('tesk').put_object(Key='out/b.txt', Body='old')
+    trans = S3Transput(str(tmp_path), "s3://tesk/out", "DIRECTORY")
+    trans.bucket_obj = client.Bucket(trans.bucket)
+    with patch('s3transfer.manager.TransferManager.upload') as mock_upload:
+        assert trans.upload_dir() == 0
+    assert [c[0][0] for c in mock_upload.call_args_list] == [str(tmp_path / 'b.txt')]
+
+
+def test_s3_output_check(moto_boto):
+    """
+    Check if the pre-flight check probes the permission to write without leaving an object
+    """
+    with S3Transput("/home/user/filer_test/", "s3://tesk/results", "DIRECTORY") as trans:
+        assert trans.output_check() == 0
+    client = boto3.resource('s3', endpoint_url="http://s3.amazonaws.com")
+    assert [obj.key for obj in client.Bucket('tesk').objects.filter(Prefix='results')] == []
+    assert 'Uploads' not in client.meta.client.list_multipart_uploads(Bucket='tesk')
+
+    denied = botocore.exceptions.ClientError(
+        {'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'}}, 'CreateMultipartUpload')
+    with S3Transput("/home/user/filer_test/", "s3://tesk/results", "DIRECTORY") as trans:
+        with patch.object(trans.bucket_obj.meta.client, 'create_multipart_upload',
+                          side_effect=denied):
+            assert trans.output_check() == 1
+
+
+def test_s3_output_check_write_only(moto_boto, caplog):
+    """
+    Check if credentials allowed to write but not to abort uploads pass the pre-flight check,
+    leaving no object behind
+    """
+    denied = botocore.exceptions.ClientError(
+        {'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'}}, 'AbortMultipartUpload')
+    with S3Transput("/home/user/filer_test/", "s3://tesk/results", "DIRECTORY") as trans:
+        with patch.object(trans.bucket_obj.meta.client, 'abort_multipart_upload',
+                          side_effect=denied):
+            assert trans.output_check() == 0
+    assert 'Unable to abort the probe upload' in caplog.text
+    client = boto3.resource('s3', endpoint_url="http://s3.amazonaws.com")
+    assert [obj.key for obj in client.Bucket('tesk').objects.filter(Prefix='results')] == []
+
+
+def test_s3_etag(tmp_path):
+    """
+        Checking if local ETags are computed like S3 does for whole and multipart uploads
+    """
+    path = tmp_path / 'parts.bin'
+    path.write_bytes(b'a' * 3 + b'b' * 3 + b'c')
+    assert s3_etag(str(path)) == hashlib.md5(b'aaabbbc').hexdigest()
+    parts = hashlib.md5(b'aaa').digest() + hashlib.md5(b'bbb').digest() + hashlib.md5(b'c').digest()
+    assert s3_etag(str(path), 3) == hashlib.md5(parts).hexdigest() + '-3'
+
 def test_upload_directory_for_unknown_file_type(moto_boto, fs, monkeypatch, caplog):
     """
         Checking whether an exception is raised when the object type is neither file or directory
@@ -172,3 +372,22 @@ def test_extract_url_from_environ_variable():
         mock_file.return_value.__iter__.return_value = read_data.splitlines()
         #assert (extract_endpoint() == "http://s3-aws-region.amazonaws.com")
         #mock_file.assert_called_once_with(os.environ["AWS_CONFIG_FILE"], encoding=None)
+
+
+def test_wait_for_transfers_failed():
+    """
+    Check if a failed transfer is reported, classified and cancels the ones after it
+    """
+    unavailable = botocore.exceptions.ClientError(
+        {'Error': {'Code': '503', 'Message': 'Slow Down'}}, 'PutObject')
+    done, failed, pending = MagicMock(), MagicMock(), MagicMock()
+    failed.result.side_effect = unavailable
+    trans = S3Transput("/home/user/filer_test/", "s3://tesk/results", "DIRECTORY")
+    assert wait_for_transfers([done, failed, pending], trans) == 1
+    assert trans.transient
+    pending.cancel.assert_called_once_with()
+
+    failed.result.side_effect = OSError('No space left on device')
+    trans.transient = False
+    assert wait_for_transfers([failed], trans) == 1
+    assert not trans.transient
@@ -0,0 +1,76 @@
+"""Tests for the filer's transfer scheduler using 'pytest'."""
+
+import threading
+import time
+
+from tesk_core.scheduler import run_transfers, host_of
+
+
+def entry(name, url, size=0):
+    return {'path': '/data/' + name, 'url': url, 'type': 'FILE', 'size': size}
+
+
+def test_host_of():
+    """ Ensure transfers are grouped by scheme and host."""
+
+    assert host_of(entry('a', 'ftp://ftp.foo.bar/a')) == ('ftp', 'ftp.foo.bar')
+    assert host_of(entry('a', '/local/a')) == ('file', '')
+    assert host_of({'path': '/data/a', 'content': 'foo'}) is None
+
+
+def test_run_transfers_largest_first():
+    """ Ensure every transfer runs, the largest ones first."""
+
+    started = []
+
+    def process(ttype, filedata):
+        started.append(filedata['path'])
+        return 0
+
+    transfers = [entry('small', 'http://foo/small', 1),
+                 entry('big', 'http://foo/big', 100),
+                 entry('medium', 'http://foo/medium', 10)]
+
+    assert run_transfers('inputs', transfers, process) == 0
+    assert started == ['/data/big', '/data/medium', '/data/small']
+
+
+def test_run_transfers_per_host_cap():
+    """ Ensure no more than 'per_host' transfers talk to a host at once."""
+
+    lock = threading.Lock()
+    active = {}
+    peak = {}
+
+    def process(ttype, filedata):
+        host = host_of(filedata)
+        with lock:
+            active[host] = active.get(host, 0) + 1
+            peak[host] = max(peak.get(host, 0), active[host])
+        time.sleep(0.01)
+        with lock:
+            active[host] -= 1
+        return 0
+
+    transfers = [entry('a%d' % i, 'http://a/%d' % i) for i in range(6)] + \
+                [entry('b%d' % i, 'ftp://b/%d' % i) for i in range(6)]
+
+    assert run_transfers('inputs', transfers, process, workers=4, per_host=2) == 0
+    assert peak == {('http', 'a'): 2, ('ftp', 'b'): 2}
+
+
+def test_run_transfers_fail_fast(caplog):
+    """ Ensure the first failure stops pending transfers from starting."""
+
+    processed = []
+
+    def process(ttype, filedata):
+        processed.append(filedata['path'])
+        return 1 if filedata['path'] == '/data/bad' else 0
+
+    transfers = [entry('bad', 'http://foo/bad', 10)] + \
+                [entry('ok%d' % i, 'http://foo/%d' % i) for i in range(5)]
+
+    assert run_transfers('inputs', transfers, process, workers=1) == 1
+    assert processed == ['/data/bad']
+    assert 'Cancelling 5 pending transfers' in caplog.text
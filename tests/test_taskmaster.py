@@ -89,6 +89,71 @@ class TaskmasterTest(unittest.TestCase):
         """
         self.assertIsInstance(generate_mounts(self.data, self.pvc),list)
 
+    @patch.dict(os.environ, {'FILER_DIRECT_FILE_INPUTS': '1'})
+    @patch('tesk_core.path.HOST_BASE_PATH', '/home/tfga/workspace/cwl-tes')
+    @patch('tesk_core.path.CONTAINER_BASE_PATH', '/transfer')
+    @patch('tesk_core.path.TRANSFER_PVC_NAME', 'transfer-pvc')
+    @patch("tesk_core.taskmaster.Job.run_to_completion", return_value="Complete")
+    @patch("tesk_core.taskmaster.logger")
+    def test_direct_file_input(self, mock_logger, mock_run_to_compl):
+        """
+        file:// inputs are mounted read-only from the transfer volume instead of being copied
+        """
+        mounts = generate_mounts(self.data, self.pvc)
+        self.assertEqual(mounts, [{'name': 'transfer-volume', 'mountPath': '/some/volume/input.txt',
+                                   'subPath': 'README.md', 'readOnly': True}])
+
+        self.pvc.set_volume_mounts(mounts)
+        executor = self.data['executors'][0]
+        run_executor(executor, taskmaster.args.namespace, self.pvc)
+        self.assertIn({'name': 'transfer-volume', 'persistentVolumeClaim': {
+            'readOnly': True, 'claimName': 'transfer-pvc'}},
+                      executor['spec']['template']['spec']['volumes'])
+
+    @patch.dict(os.environ, {'PVC_SIZE_HEADROOM': '20'})
+    @patch("tesk_core.taskmaster.input_size", return_value=(10 * 1024 ** 3, 1))
+    @patch("tesk_core.taskmaster.logger")
+    def test_plan_inputs_auto_size(self, mock_logger, mock_input_size):
+        """
+        disk_gb grows to fit the inputs plus headroom
+        """
+        taskmaster.plan_inputs(self.data)
+        self.assertEqual(self.data['resources']['disk_gb'], 12)
+        self.assertEqual(self.data['inputs'][0]['size'], 10 * 1024 ** 3)
+
+    @patch.dict(os.environ, {'NETRC_SECRET_NAME': 'netrc'})
+    @patch("tesk_core.taskmaster.ftp_pool.close_all")
+    @patch("tesk_core.taskmaster.input_size", return_value=(None, None))
+    @patch("tesk_core.taskmaster.logger")
+    def test_plan_inputs_credentials(self, mock_logger, mock_input_size, mock_close_all):
+        """
+        Inputs are only found missing when probed with the credentials of the filer,
+        and FTP connections are closed after planning
+        """
+        self.data['inputs'] = [{'url': 'http://foo/a', 'path': '/a', 'type': 'FILE'},
+                               {'url': 'ftp://foo/b', 'path': '/b', 'type': 'FILE'}]
+        taskmaster.plan_inputs(self.data)
+        self.assertEqual(sorted(c[0][1] for c in mock_input_size.call_args_list), [False, False])
+        mock_close_all.assert_called_once_with()
+
+        mock_input_size.reset_mock()
+        del os.environ['NETRC_SECRET_NAME']
+        self.data['inputs'].append({'url': 's3://bucket/c', 'path': '/c', 'type': 'FILE'})
+        taskmaster.plan_inputs(self.data)
+        self.assertEqual({c[0][0]['url']: c[0][1] for c in mock_input_size.call_args_list},
+                         {'http://foo/a': True, 'ftp://foo/b': True, 's3://bucket/c': False})
+
+    @patch("tesk_core.taskmaster.input_size", side_effect=FileNotFoundError('404'))
+    @patch("tesk_core.taskmaster.PVC.create")
+    @patch("tesk_core.taskmaster.logger")
+    def test_plan_inputs_missing(self, mock_logger, mock_pvc_create, mock_input_size):
+        """
+        A task with a missing input is given up before the PVC is created
+        """
+        with patch.dict(os.environ, {'PLAN_INPUTS': '1'}), self.assertRaises(SystemExit):
+            run_task(self.data, taskmaster.args.filer_name, taskmaster.args.filer_version)
+        mock_pvc_create.assert_not_called()
+
     @patch("tesk_core.taskmaster.logger")
     def test_append_mount(self, mock_logger):
         """
@@ -112,6 +177,38 @@ class TaskmasterTest(unittest.TestCase):
         """
         run_task(self.data, taskmaster.args.filer_name, taskmaster.args.filer_version)
 
+    @patch.dict(os.environ, {'SINGLE_POD_TASK': 'emptyDir', 'EXECUTOR_BACKOFF_LIMIT': '1',
+                             'FILER_BACKOFF_LIMIT': '3'})
+    @patch('tesk_core.taskmaster.logger')
+    @patch('tesk_core.taskmaster.PVC.create')
+    @patch('tesk_core.taskmaster.Job.run_to_completion', return_value='Complete')
+    def test_run_task_single_pod(self, mock_job, mock_pvc_create, mock_logger):
+        """
+        Testing if the filers and executors run as containers of a single pod sharing an emptyDir
+        """
+        executor_spec = self.data['executors'][0]['spec']['template']['spec']
+        del executor_spec['restartPolicy']
+        executor_spec['restart_policy'] = 'OnFailure'
+        run_task(self.data, taskmaster.args.filer_name, taskmaster.args.filer_version)
+
+        mock_pvc_create.assert_not_called()
+        self.assertEqual(len(taskmaster.created_jobs), 1)
+        spec = taskmaster.created_jobs[0].body['spec']['template']['spec']
+        self.assertEqual([c['name'] for c in spec['initContainers']], ['inputs-filer', 'task-1000-ex-00'])
+        self.assertEqual([c['name'] for c in spec['containers']], ['outputs-filer'])
+        self.assertEqual(spec['containers'][0]['args'][0], 'outputs')
+        self.assertIn({'name': 'task-volume', 'emptyDir': {'sizeLimit': '0.1Gi'}}, spec['volumes'])
+        self.assertEqual(spec['restartPolicy'], 'OnFailure')
+        self.assertEqual(taskmaster.created_jobs[0].body['spec']['backoffLimit'], 1)
+        metadata = taskmaster.created_jobs[0].body['metadata']
+        self.assertEqual(metadata['name'], 'task-1000-task')
+        self.assertEqual(metadata['labels']['job-type'], 'task')
+        self.assertNotIn('executor-no', metadata['labels'])
+        self.assertEqual(metadata['labels']['taskmaster-name'], 'task-1000')
+        self.assertEqual(metadata['annotations']['executor-containers'], 'task-1000-ex-00')
+        self.assertIn({'name': 'task-volume', 'mountPath': '/some/volume', 'subPath': 'dir0'},
+                      spec['initContainers'][1]['volumeMounts'])
+
     def test_localKubeConfig(self):
         """
 